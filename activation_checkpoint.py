@@ -0,0 +1,77 @@
+"""Activation checkpointing of the sequential stages of torchvision models.
+
+With --act-checkpoint N, every nn.Sequential child of the model with more than
+one module (layer1-4 of the ResNets, features of VGG, DenseNet, MobileNet,
+EfficientNet, ...) runs as N >= 2 segments while training, all but the last
+checkpointed: only the segment boundaries keep their activations, the rest is
+recomputed during backward. That trades about one extra forward pass for activation memory, so
+bigger batches fit on a device. --act-checkpoint-stages limits it to some
+stages, e.g. the early, high-resolution ones that hold most activations.
+
+The stages keep their module names, so state dicts and checkpoints are the same
+with and without it. BN layers inside a checkpointed segment run forward again
+when it is recomputed; they normalize with the batch statistics as before but
+leave their running statistics alone, so those are updated once per step, as
+without checkpointing.
+"""
+import collections
+import contextlib
+
+import torch.nn as nn
+import torch.utils.checkpoint
+
+
+@contextlib.contextmanager
+def frozen_bn_stats(bns):
+    """BN layers bns normalize with batch statistics without updating their running ones"""
+    for bn in bns:
+        bn.track_running_stats = False
+    try:
+        yield
+    finally:
+        for bn in bns:
+            bn.track_running_stats = True
+
+
+class CheckpointedSequential(nn.Sequential):
+    def __init__(self, modules, segments):
+        super(CheckpointedSequential, self).__init__(modules)
+        self.segments = min(segments, len(modules))
+
+    def forward(self, input):
+        if not (self.training and torch.is_grad_enabled()):
+            return super(CheckpointedSequential, self).forward(input)
+        # split like checkpoint_sequential: the last segment isn't checkpointed,
+        # its activations are needed for backward right away
+        modules = list(self)
+        size = len(modules) // self.segments
+        start = 0
+        for _ in range(self.segments - 1):
+            segment = nn.Sequential(*modules[start:start + size])
+            # the recompute runs under the second context, the forward under the first
+            bns = [m for m in segment.modules()
+                   if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+            input = torch.utils.checkpoint.checkpoint(
+                segment, input, use_reentrant=False,
+                context_fn=lambda bns=bns: (contextlib.nullcontext(), frozen_bn_stats(bns)))
+            start += size
+        for module in modules[start:]:
+            input = module(input)
+        return input
+
+
+def apply(model, segments, stages=None):
+    """Checkpoint the stages of model in place; returns the names of the checkpointed stages"""
+    names = []
+    if segments <= 0:
+        return names
+    if segments == 1:
+        # the last segment is never checkpointed, so one segment would change nothing
+        raise ValueError('--act-checkpoint needs at least 2 segments, 0 turns it off')
+    for name, child in list(model.named_children()):
+        if stages and name not in stages:
+            continue
+        if type(child) is nn.Sequential and len(child) > 1:
+            setattr(model, name, CheckpointedSequential(collections.OrderedDict(child.named_children()), segments))
+            names.append(name)
+    return names
@@ -0,0 +1,92 @@
+"""Batched random-resized-crop and flip on the training device.
+
+RandomResizedCrop and RandomHorizontalFlip in PIL are most of the per-image CPU
+work of the loader workers. With --batch-augment the workers only decode and
+pre-resize every image to a fixed-size source; BatchAugment then draws the crop
+boxes and flips of a whole batch at once and applies them as a single affine
+grid_sample on whatever device the model is on.
+
+The parameters follow torchvision's RandomResizedCrop (10 tries, then the central
+crop clamped to the ratio range) and are drawn from a CPU generator seeded from
+(seed, epoch, rank), so every run and device sees the same crops. The resize is
+bilinear without antialiasing, unlike PIL's.
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment(object):
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), flip=True, seed=0, rank=0):
+        self.size = size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.ratio = ratio
+        self.flip = flip
+        self.seed = seed
+        self.rank = rank
+        self.generator = torch.Generator()
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, skip_batches=0, batch_size=0):
+        """Reseed for epoch, then skip the draws of the first skip_batches batches (mid-epoch resume)"""
+        self.generator.manual_seed((self.seed * 1000 + epoch) * 100003 + self.rank)
+        for _ in range(skip_batches):
+            self.sample(batch_size, 1, 1)
+
+    def sample(self, n, height, width, tries=10):
+        """Crop boxes (top, left, h, w) and flip flags for n images of height x width"""
+        g = self.generator
+        area = height * width
+        target_area = area * torch.empty(n, tries).uniform_(self.scale[0], self.scale[1], generator=g)
+        aspect = torch.exp(torch.empty(n, tries).uniform_(self.log_ratio[0], self.log_ratio[1], generator=g))
+        w = torch.sqrt(target_area * aspect).round()
+        h = torch.sqrt(target_area / aspect).round()
+        valid = (w > 0) & (h > 0) & (w <= width) & (h <= height)
+
+        # first valid try per image
+        first = valid.to(torch.uint8).argmax(1, keepdim=True)
+        w = w.gather(1, first).squeeze(1)
+        h = h.gather(1, first).squeeze(1)
+
+        # no valid try: central crop with the ratio clamped to the allowed range
+        in_ratio = width / height
+        if in_ratio < self.ratio[0]:
+            fallback = (round(width / self.ratio[0]), width)
+        elif in_ratio > self.ratio[1]:
+            fallback = (height, round(height * self.ratio[1]))
+        else:
+            fallback = (height, width)
+        found = valid.any(1)
+        h = torch.where(found, h, torch.tensor(float(fallback[0])))
+        w = torch.where(found, w, torch.tensor(float(fallback[1])))
+
+        top = torch.floor(torch.rand(n, generator=g) * (height - h + 1))
+        left = torch.floor(torch.rand(n, generator=g) * (width - w + 1))
+        top = torch.where(found, top, torch.floor((height - h) / 2))
+        left = torch.where(found, left, torch.floor((width - w) / 2))
+        if self.flip:
+            flip = torch.rand(n, generator=g) < 0.5
+        else:
+            flip = torch.zeros(n, dtype=torch.bool)
+        return top, left, h, w, flip
+
+    def __call__(self, input):
+        """Random-resized-crop and flip a float NCHW batch to size x size"""
+        n, _, height, width = input.shape
+        top, left, h, w, flip = self.sample(n, height, width)
+
+        # affine_grid maps the output onto [-1, 1] input coordinates
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = torch.where(flip, -w / width, w / width)
+        theta[:, 0, 2] = (2 * left + w) / width - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (2 * top + h) / height - 1
+        theta = theta.to(input.device, input.dtype, non_blocking=True)
+
+        grid = F.affine_grid(theta, (n, input.size(1), self.size, self.size), align_corners=False)
+        output = F.grid_sample(input, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        if input.is_contiguous(memory_format=torch.channels_last):
+            output = output.contiguous(memory_format=torch.channels_last)
+        return output
@@ -0,0 +1,74 @@
+"""CPU micro-benchmark: FastCollate vs. the original fast_collate.
+
+python bench_collate.py --batch-size 128 --iters 50 --channels-last
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from collate import FastCollate
+
+
+def reference_collate(batch, memory_format):
+    # fast_collate as it was in torch_distributed_ddp_imagenet.py
+    imgs = [img[0] for img in batch]
+    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
+    w = imgs[0].size[0]
+    h = imgs[0].size[1]
+    tensor = torch.zeros( (len(imgs), 3, h, w), dtype=torch.uint8).contiguous(memory_format=memory_format)
+    for i, img in enumerate(imgs):
+        nump_array = np.asarray(img, dtype=np.uint8)
+        if(nump_array.ndim < 3):
+            nump_array = np.expand_dims(nump_array, axis=-1)
+        nump_array = np.rollaxis(nump_array, 2)
+        nump_array_writable = copy.deepcopy(nump_array)
+        tensor[i] += torch.from_numpy(nump_array_writable)
+    return tensor, targets
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='collate micro-benchmark')
+    parser.add_argument('-b', '--batch-size', default=128, type=int, metavar='N')
+    parser.add_argument('--crop-size', default=224, type=int, metavar='N')
+    parser.add_argument('--iters', default=50, type=int, metavar='N')
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--num-buffers', default=2, type=int, metavar='N', help='recycled buffers for FastCollate (default: 2)')
+    return parser.parse_args()
+
+
+def bench(collate_fn, batch, iters):
+    collate_fn(batch)
+    start = time.perf_counter()
+    for _ in range(iters):
+        collate_fn(batch)
+    return iters * len(batch) / (time.perf_counter() - start)
+
+
+def main():
+    args = parse()
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+
+    rng = np.random.RandomState(0)
+    batch = []
+    for i in range(args.batch_size):
+        img = Image.fromarray(rng.randint(0, 256, (args.crop_size, args.crop_size, 3), dtype=np.uint8))
+        batch.append((img, i % 1000))
+
+    reference = bench(lambda b: reference_collate(b, memory_format), batch, args.iters)
+    fast = bench(FastCollate(memory_format, num_buffers=args.num_buffers), batch, args.iters)
+
+    # sanity check that both produce the same batch
+    ref_out, _ = reference_collate(batch, memory_format)
+    fast_out, _ = FastCollate(memory_format)(batch)
+    assert torch.equal(ref_out, fast_out)
+
+    print('fast_collate  {:10.1f} images/sec'.format(reference))
+    print('FastCollate   {:10.1f} images/sec  ({:.2f}x)'.format(fast, fast / reference))
+
+
+if __name__ == '__main__':
+    main()
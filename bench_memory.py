@@ -0,0 +1,63 @@
+"""Peak memory vs. throughput of batch size, activation checkpointing and accumulation.
+
+Runs the model step of benchmark.py for every combination of --batch-sizes,
+--act-checkpoint and --accum-steps in a fresh process (see bench_precision.py)
+and reports images/sec, peak memory and the effective batch of an optimizer step
+per process, to find the cheapest way to a target effective batch on a device.
+
+python bench_memory.py --device cpu --arch resnet50 --batch-sizes 32 64 --act-checkpoint 0 2 4
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+
+import torchvision.models as models
+
+from bench_precision import run_config
+from device import default_device
+from precision import PRECISIONS
+
+
+def parse():
+    model_names = sorted(name for name in models.__dict__ if name.islower() and not name.startswith("__") and callable(models.__dict__[name]))
+
+    parser = argparse.ArgumentParser(description='activation checkpointing and accumulation benchmark')
+    parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet50', choices=model_names)
+    parser.add_argument('--device', type=str, default=default_device(), choices=['cuda', 'cpu'])
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS)
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[32, 64, 128], metavar='N')
+    parser.add_argument('--act-checkpoint', nargs='+', type=int, default=[0, 2, 4], metavar='N', help='segments per stage, 0 for off, else at least 2')
+    parser.add_argument('--accum-steps', nargs='+', type=int, default=[1], metavar='N')
+    parser.add_argument('--crop-size', default=224, type=int, metavar='N')
+    parser.add_argument('--iters', default=20, type=int, metavar='N')
+    parser.add_argument('--warmup', default=5, type=int, metavar='N')
+    parser.add_argument('--output', type=str, default='', metavar='FILE', help='write results as JSON to FILE')
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    ctx = multiprocessing.get_context('spawn')
+
+    results = []
+    for batch_size, segments, accum_steps in itertools.product(args.batch_sizes, args.act_checkpoint, args.accum_steps):
+        config = dict(arch=args.arch, precision=args.precision, channels_last=args.channels_last, device=args.device,
+                      batch_size=batch_size, crop_size=args.crop_size, iters=args.iters * accum_steps,
+                      warmup=args.warmup * accum_steps, act_checkpoint=segments, accum_steps=accum_steps)
+        with ctx.Pool(1) as pool:
+            r = pool.apply(run_config, (config,))
+        r['effective_batch_size'] = batch_size * accum_steps
+        results.append(r)
+        print('{:<12} -b {:<4} --act-checkpoint {:<2} --accum-steps {:<2} effective {:<5} {:10.1f} images/sec  peak {:8.0f} MB'
+              .format(args.arch, batch_size, segments, accum_steps, r['effective_batch_size'],
+                      r['images_per_sec'], r['peak_mb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
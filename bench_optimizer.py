@@ -0,0 +1,92 @@
+"""Micro-benchmark of the per-iteration optimizer work: LR update plus SGD step.
+
+Compares the original per-step adjust_learning_rate() + per-parameter SGD with
+LRSchedule.apply() + foreach and fused SGD (where torch supports fused SGD on
+the device), on the parameters of a torchvision model with random gradients.
+
+python bench_optimizer.py --device cpu --arch resnet50 --iters 100
+"""
+import argparse
+import time
+
+import torch
+import torchvision.models as models
+
+from device import DeviceContext, default_device
+from optimization import LRSchedule, decay_factor, make_sgd
+
+
+def adjust_learning_rate(optimizer, base_lr, epoch, step, len_epoch):
+    # as it was in torch_distributed_ddp_imagenet.py
+    lr = base_lr * (0.1 ** decay_factor(epoch))
+    if epoch < 5:
+        lr = lr * float(1 + step + epoch * len_epoch) / (5. * len_epoch)
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = lr
+
+
+def bench(model, device, impl, bn_weight_decay, schedule, iters, warmup, len_epoch):
+    """Microseconds per iteration of LR update + optimizer.step()"""
+    optimizer = make_sgd(model, 0.1, 0.9, 1e-4, impl=impl, bn_weight_decay=bn_weight_decay)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+    lr_schedule = LRSchedule(0.1, 90, len_epoch)
+
+    def step(i):
+        # late enough in the run that the warmup is over, like most of training
+        epoch, s = 10 + i // len_epoch, i % len_epoch + 1
+        if schedule:
+            lr_schedule.apply(optimizer, epoch, s)
+        else:
+            adjust_learning_rate(optimizer, 0.1, epoch, s, len_epoch)
+        optimizer.step()
+
+    for i in range(warmup):
+        step(i)
+    device.synchronize()
+    start = time.perf_counter()
+    for i in range(iters):
+        step(warmup + i)
+    device.synchronize()
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+def parse():
+    model_names = sorted(name for name in models.__dict__ if name.islower() and not name.startswith("__") and callable(models.__dict__[name]))
+
+    parser = argparse.ArgumentParser(description='optimizer step micro-benchmark')
+    parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet50', choices=model_names)
+    parser.add_argument('--device', type=str, default=default_device(), choices=['cuda', 'cpu'])
+    parser.add_argument('--iters', default=100, type=int, metavar='N')
+    parser.add_argument('--warmup', default=10, type=int, metavar='N')
+    parser.add_argument('--len-epoch', default=5005, type=int, metavar='N', help='steps per epoch for the LR schedule (default: 5005)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    device = DeviceContext(args.device)
+    device.set_current()
+    model = models.__dict__[args.arch]().to(device.device)
+    print('{}: {} parameter tensors on {}'.format(args.arch, len(list(model.parameters())), device.name()))
+
+    configs = [
+        ('adjust_learning_rate + for-loop SGD', 'for-loop', True, False),
+        ('LRSchedule + for-loop SGD', 'for-loop', False, True),
+        ('LRSchedule + foreach SGD', 'foreach', False, True),
+        ('LRSchedule + fused SGD', 'fused', False, True),
+    ]
+    reference = None
+    for name, impl, bn_weight_decay, schedule in configs:
+        try:
+            us = bench(model, device, impl, bn_weight_decay, schedule, args.iters, args.warmup, args.len_epoch)
+        except (RuntimeError, TypeError) as e:
+            # fused SGD needs a recent torch, and for cpu a more recent one
+            print('{:<40} unsupported: {}'.format(name, e))
+            continue
+        reference = reference or us
+        print('{:<40} {:10.1f} us/iter  ({:.2f}x)'.format(name, us, reference / us))
+
+
+if __name__ == '__main__':
+    main()
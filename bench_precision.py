@@ -0,0 +1,104 @@
+"""Step time and peak memory per precision and memory format.
+
+Every combination of --archs, --precisions and contiguous/channels-last runs the
+model scenario of benchmark.py (forward, backward and optimizer step on a fixed
+synthetic batch) in a fresh process, so the peak memory of one doesn't hide that
+of the next: max_memory_allocated on cuda, the peak RSS of the process on cpu.
+A combination counts as safe if its mean loss stays finite and within --loss-tol
+of fp32's, and the fastest safe one is reported per arch.
+
+python bench_precision.py --device cpu --archs resnet18 resnet50 -b 32
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import resource
+
+import torch
+
+from benchmark import ModelStep, measure
+from device import DeviceContext, default_device
+from precision import PRECISIONS
+
+
+def run_config(config):
+    """One combination, in its own process"""
+    torch.manual_seed(0)
+    device = DeviceContext(config['device'])
+    device.set_current()
+    memory_format = torch.channels_last if config['channels_last'] else torch.contiguous_format
+    args = argparse.Namespace(arch=config['arch'], precision=config['precision'], distributed=False,
+                              accum_steps=config.get('accum_steps', 1), act_checkpoint=config.get('act_checkpoint', 0),
+                              compile='none', compile_mode=None)
+    step = ModelStep(args, device, memory_format)
+    input = torch.randn(config['batch_size'], 3, config['crop_size'], config['crop_size'], device=device.device)
+    input = input.contiguous(memory_format=memory_format)
+    target = torch.randint(0, 1000, (config['batch_size'],), device=device.device)
+
+    losses = []
+    if device.is_cuda:
+        torch.cuda.reset_peak_memory_stats(device.device)
+    result = measure(lambda: losses.append(step(input, target).detach()), config['batch_size'],
+                     config['iters'], config['warmup'], device)
+    if device.is_cuda:
+        result['peak_mb'] = torch.cuda.max_memory_allocated(device.device) / (1 << 20)
+    else:
+        # kilobytes on linux
+        result['peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    result['loss'] = torch.stack(losses[-config['iters']:]).float().mean().item()
+    result.update(config)
+    return result
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='precision and memory format benchmark')
+    parser.add_argument('--archs', nargs='+', default=['resnet18', 'resnet50'])
+    parser.add_argument('--precisions', nargs='+', default=None, choices=PRECISIONS, help='(default: fp32 bf16, plus fp16 on cuda)')
+    parser.add_argument('--device', type=str, default=default_device(), choices=['cuda', 'cpu'])
+    parser.add_argument('-b', '--batch-size', default=64, type=int, metavar='N')
+    parser.add_argument('--crop-size', default=224, type=int, metavar='N')
+    parser.add_argument('--iters', default=20, type=int, metavar='N')
+    parser.add_argument('--warmup', default=5, type=int, metavar='N')
+    parser.add_argument('--loss-tol', default=0.05, type=float, metavar='T', help='largest relative loss deviation from fp32 that still counts as safe (default: 0.05)')
+    parser.add_argument('--output', type=str, default='', metavar='FILE', help='write results as JSON to FILE')
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    precisions = args.precisions or (['fp32', 'bf16', 'fp16'] if args.device == 'cuda' else ['fp32', 'bf16'])
+    ctx = multiprocessing.get_context('spawn')
+
+    results = []
+    for arch in args.archs:
+        arch_results = []
+        for precision in precisions:
+            for channels_last in (False, True):
+                config = dict(arch=arch, precision=precision, channels_last=channels_last, device=args.device,
+                              batch_size=args.batch_size, crop_size=args.crop_size, iters=args.iters,
+                              warmup=args.warmup)
+                with ctx.Pool(1) as pool:
+                    arch_results.append(pool.apply(run_config, (config,)))
+
+        reference = [r['loss'] for r in arch_results if r['precision'] == 'fp32']
+        for r in arch_results:
+            r['safe'] = math.isfinite(r['loss']) and (
+                not reference or abs(r['loss'] - reference[0]) <= args.loss_tol * abs(reference[0]))
+            print('{:<12} {:<5} {:<14} {:10.1f} images/sec  p50 {:8.2f} ms  peak {:8.0f} MB  loss {:.4f}{}'.format(
+                  arch, r['precision'], 'channels_last' if r['channels_last'] else 'contiguous',
+                  r['images_per_sec'], r['p50_ms'], r['peak_mb'], r['loss'], '' if r['safe'] else '  UNSAFE'))
+        safe = [r for r in arch_results if r['safe']]
+        if safe:
+            best = max(safe, key=lambda r: r['images_per_sec'])
+            print('{:<12} fastest safe: --precision {}{}'.format(
+                  arch, best['precision'], ' --channels-last' if best['channels_last'] else ''))
+        results.extend(arch_results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
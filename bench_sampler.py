@@ -0,0 +1,103 @@
+"""Straggler simulation: DistributedSampler vs. BalancedDistributedSampler.
+
+Every rank of a step waits for the slowest one, and a rank's batch takes about as
+long as decoding its images, which scales with their encoded size. For one epoch
+of each sampler this takes the file sizes as decode cost and reports how much
+longer the slowest rank's batch is than the average one (the straggler overhead),
+plus how many blocks of --block-size consecutive samples a batch reads from.
+Without --data the sizes are drawn from a log-normal fit of ImageNet train.
+
+python bench_sampler.py --world-size 8 -b 128
+python bench_sampler.py --data /ssd2/imagenet_packed --data-format packed --world-size 32
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.utils.data
+
+from dataset_index import shared_index
+from packed_dataset import PackedDataset
+from samplers import BalancedDistributedSampler
+
+
+class Sizes(torch.utils.data.Dataset):
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+def load_sizes(args):
+    if not args.data:
+        rng = np.random.RandomState(0)
+        return rng.lognormal(np.log(110e3), 0.6, args.length).astype(np.int64)
+    traindir = os.path.join(args.data, 'train')
+    if args.data_format == 'packed':
+        return PackedDataset(traindir).sizes
+    return shared_index(traindir, args.index_cache)['sizes']
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='sampler straggler simulation')
+    parser.add_argument('--data', type=str, default='', metavar='DIR', help='dataset root, synthetic sizes if empty (default: synthetic)')
+    parser.add_argument('--data-format', type=str, default='folder', choices=['folder', 'packed'])
+    parser.add_argument('--index-cache', type=str, default=os.path.expanduser('~/.cache/imagenet_distributed_torch/index'), metavar='DIR')
+    parser.add_argument('--length', default=1281167, type=int, metavar='N', help='synthetic dataset size (default: ImageNet train)')
+    parser.add_argument('--world-size', default=8, type=int, metavar='N')
+    parser.add_argument('-b', '--batch-size', default=128, type=int, metavar='N')
+    parser.add_argument('--block-size', default=64, type=int, metavar='N')
+    parser.add_argument('--window', default=1024, type=int, metavar='N')
+    parser.add_argument('--epoch', default=0, type=int, metavar='N')
+    return parser.parse_args()
+
+
+def simulate(samplers, sizes, batch_size, block_size):
+    """Straggler overhead and locality of one epoch, given every rank's sampler"""
+    start = time.perf_counter()
+    shares = [np.array(list(iter(s)), dtype=np.int64) for s in samplers]
+    elapsed = (time.perf_counter() - start) / len(samplers)
+
+    # every sample exactly once per epoch, up to the padding
+    seen = np.concatenate(shares)
+    assert len(np.unique(seen)) == len(sizes)
+
+    steps = len(shares[0]) // batch_size
+    batches = np.stack([s[:steps * batch_size].reshape(steps, batch_size) for s in shares])
+    cost = sizes[batches].sum(axis=2).astype(np.float64)  # (ranks, steps)
+    slowest, mean = cost.max(axis=0), cost.mean(axis=0)
+    blocks = [len(np.unique(b // block_size)) for b in batches.reshape(-1, batch_size)]
+    return {
+        'overhead': slowest.sum() / mean.sum() - 1.,
+        'p99_ratio': float(np.percentile(slowest / mean, 99)),
+        'blocks_per_batch': float(np.mean(blocks)),
+        'iter_s': elapsed,
+    }
+
+
+def main():
+    args = parse()
+    sizes = np.asarray(load_sizes(args))
+    dataset = Sizes(sizes)
+
+    samplers = {
+        'DistributedSampler': [torch.utils.data.distributed.DistributedSampler(
+            dataset, num_replicas=args.world_size, rank=r) for r in range(args.world_size)],
+        'Balanced': [BalancedDistributedSampler(
+            dataset, num_replicas=args.world_size, rank=r, batch_size=args.batch_size, costs=sizes,
+            block_size=args.block_size, window=args.window) for r in range(args.world_size)],
+    }
+    print('{} samples, {} ranks x {} per batch'.format(len(sizes), args.world_size, args.batch_size))
+    for name, ranks in samplers.items():
+        for s in ranks:
+            s.set_epoch(args.epoch)
+        r = simulate(ranks, sizes, args.batch_size, args.block_size)
+        print('{:<20} straggler overhead {:6.2%}  p99 slowest/mean {:.3f}  {:6.1f} blocks per batch  {:.2f} s per epoch order'
+              .format(name, r['overhead'], r['p99_ratio'], r['blocks_per_batch'], r['iter_s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""Throughput benchmarks for the training pipeline.
+
+Scenarios:
+    loader      DataLoader + FastCollate only
+    prefetcher  loader + PrefetchQueue (copy to device and normalization)
+    model       forward/backward/optimizer step on synthetic device tensors
+    full        prefetcher + model step, i.e. what train() does
+    compile     model step eager and with --compile (default: step), and the speedup
+
+Every scenario reports steady-state images/sec, p50/p95/p99 step latency and the
+warmup time, and --output writes all results as JSON for tracking regressions.
+Without --data a synthetic dataset of in-memory JPEGs is used, so no ImageNet is
+needed:
+
+python benchmark.py --device cpu -b 32 -j 4 --scenarios loader model full --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data
+import torchvision.datasets as datasets
+import torchvision.models as models
+import torchvision.transforms as transforms
+from PIL import Image
+
+import activation_checkpoint
+from batch_augment import BatchAugment
+from collate import FastCollate
+import compiled_step
+from device import DeviceContext, default_device
+import grad_sync
+from packed_dataset import PackedDataset
+from precision import PRECISIONS, MixedPrecision
+from prefetch import PrefetchQueue
+
+
+class SyntheticDataset(torch.utils.data.Dataset):
+    """length samples drawn from a small pool of random JPEGs, decoded per sample like ImageFolder"""
+    def __init__(self, length, image_size=(500, 375), num_classes=1000, transform=None, pool=64, seed=0):
+        rng = np.random.RandomState(seed)
+        self.length = length
+        self.transform = transform
+        self.images = []
+        for _ in range(pool):
+            # smooth noise, so the files have a realistic size for their resolution
+            small = rng.randint(0, 256, (image_size[1] // 8, image_size[0] // 8, 3), dtype=np.uint8)
+            img = Image.fromarray(small).resize(image_size, Image.BILINEAR)
+            buf = io.BytesIO()
+            img.save(buf, format='JPEG', quality=90)
+            self.images.append(buf.getvalue())
+        self.targets = rng.randint(0, num_classes, length).tolist()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        img = Image.open(io.BytesIO(self.images[index % len(self.images)])).convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, self.targets[index]
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q) * 1000.)
+
+
+def measure(step, batch_size, iters, warmup, device):
+    """Run step() warmup + iters times, timing every steady-state call"""
+    start = time.perf_counter()
+    for _ in range(warmup):
+        step()
+    device.synchronize()
+    warmup_time = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(iters):
+        t = time.perf_counter()
+        step()
+        device.synchronize()
+        latencies.append(time.perf_counter() - t)
+    total = sum(latencies)
+    return {
+        'images_per_sec': iters * batch_size / total,
+        'p50_ms': percentile_ms(latencies, 50),
+        'p95_ms': percentile_ms(latencies, 95),
+        'p99_ms': percentile_ms(latencies, 99),
+        'warmup_s': warmup_time,
+        'iters': iters,
+    }
+
+
+def make_dataset(args, length):
+    if args.batch_augment:
+        # fixed-size sources, cropped and flipped by BatchAugment in the prefetcher
+        transform = transforms.Compose([
+            transforms.Resize(args.batch_augment_source),
+            transforms.CenterCrop(args.batch_augment_source),
+        ])
+    else:
+        transform = transforms.Compose([
+            transforms.RandomResizedCrop(args.crop_size),
+            transforms.RandomHorizontalFlip(),
+        ])
+    if not args.data:
+        return SyntheticDataset(length, transform=transform)
+    traindir = os.path.join(args.data, 'train')
+    if args.data_format == 'packed':
+        return PackedDataset(traindir, transform)
+    return datasets.ImageFolder(traindir, transform)
+
+
+def make_loader(args, memory_format):
+    # enough samples that no scenario runs out of batches
+    dataset = make_dataset(args, args.batch_size * (args.warmup + args.iters + 1))
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers,
+        pin_memory=False, collate_fn=FastCollate(memory_format), drop_last=True)
+
+
+class ModelStep(object):
+    """One training micro-step: forward, loss, backward and, every accum_steps calls, the optimizer step"""
+    def __init__(self, args, device, memory_format):
+        self.model = models.__dict__[args.arch]()
+        activation_checkpoint.apply(self.model, args.act_checkpoint)
+        self.model = self.model.to(device.device, memory_format=memory_format)
+        self.model.train()
+        self.criterion = nn.CrossEntropyLoss().to(device.device)
+        self.optimizer = torch.optim.SGD(self.model.parameters(), 0.1, momentum=0.9, weight_decay=1e-4)
+        if args.distributed:
+            self.model = grad_sync.wrap(self.model, args.grad_sync, device, bucket_cap_mb=args.bucket_cap_mb,
+                                        compression=args.grad_compression, powersgd_rank=args.powersgd_rank)
+        self.precision = MixedPrecision(args.precision, device)
+        self.forward = compiled_step.setup(self.model, self.criterion, self.optimizer, self.precision, device,
+                                           compile=args.compile, mode=args.compile_mode)
+        self.accum_steps = args.accum_steps
+        self.calls = 0
+
+    def __call__(self, input, target):
+        self.calls += 1
+        last = self.calls % self.accum_steps == 0
+        if (self.calls - 1) % self.accum_steps == 0:
+            self.optimizer.zero_grad()
+        # DDP decides in its forward whether backward syncs
+        with contextlib.nullcontext() if last else grad_sync.no_sync(self.model):
+            output, loss = self.forward(input, target)
+            self.precision.backward(loss / self.accum_steps)
+        if last:
+            self.precision.step(self.optimizer)
+        return loss
+
+
+def bench_loader(args, device, memory_format):
+    it = iter(make_loader(args, memory_format))
+    return measure(lambda: next(it), args.batch_size, args.iters, args.warmup, device)
+
+
+def make_prefetcher(args, device, memory_format):
+    augment = BatchAugment(args.crop_size) if args.batch_augment else None
+    return PrefetchQueue(make_loader(args, memory_format), device, args.prefetch_depth, augment=augment)
+
+
+def bench_prefetcher(args, device, memory_format):
+    prefetcher = make_prefetcher(args, device, memory_format)
+    result = measure(prefetcher.next, args.batch_size, args.iters, args.warmup, device)
+    result['prefetch'] = prefetcher.stats()
+    prefetcher.close()
+    return result
+
+
+def bench_model(args, device, memory_format):
+    step = ModelStep(args, device, memory_format)
+    input = torch.randn(args.batch_size, 3, args.crop_size, args.crop_size, device=device.device)
+    input = input.contiguous(memory_format=memory_format)
+    target = torch.randint(0, 1000, (args.batch_size,), device=device.device)
+    return measure(lambda: step(input, target), args.batch_size, args.iters, args.warmup, device)
+
+
+def bench_full(args, device, memory_format):
+    step = ModelStep(args, device, memory_format)
+    prefetcher = make_prefetcher(args, device, memory_format)
+    result = measure(lambda: step(*prefetcher.next()), args.batch_size, args.iters, args.warmup, device)
+    result['prefetch'] = prefetcher.stats()
+    prefetcher.close()
+    return result
+
+
+def bench_compile(args, device, memory_format):
+    eager = bench_model(argparse.Namespace(**dict(vars(args), compile='none')), device, memory_format)
+    compiled = bench_model(argparse.Namespace(**dict(vars(args), compile=args.compile if args.compile != 'none' else 'step')),
+                           device, memory_format)
+    compiled['eager'] = eager
+    compiled['speedup'] = compiled['images_per_sec'] / eager['images_per_sec']
+    return compiled
+
+
+SCENARIOS = {
+    'loader': bench_loader,
+    'prefetcher': bench_prefetcher,
+    'model': bench_model,
+    'full': bench_full,
+    'compile': bench_compile,
+}
+
+
+def parse():
+    model_names = sorted(name for name in models.__dict__ if name.islower() and not name.startswith("__") and callable(models.__dict__[name]))
+
+    parser = argparse.ArgumentParser(description='ImageNet pipeline benchmarks')
+    parser.add_argument('--scenarios', nargs='+', default=['loader', 'prefetcher', 'model', 'full'], choices=sorted(SCENARIOS))
+    parser.add_argument('--data', type=str, default='', metavar='DIR', help='dataset root, synthetic data if empty (default: synthetic)')
+    parser.add_argument('--data-format', type=str, default='folder', choices=['folder', 'packed'])
+    parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18', choices=model_names)
+    parser.add_argument('-j', '--workers', default=4, type=int, metavar='N')
+    parser.add_argument('-b', '--batch-size', default=64, type=int, metavar='N')
+    parser.add_argument('--crop-size', default=224, type=int, metavar='N')
+    parser.add_argument('--prefetch-depth', default=2, type=int, metavar='N')
+    parser.add_argument('--batch-augment', action='store_true', help='crop and flip batched on the device (BatchAugment) instead of in the loader')
+    parser.add_argument('--batch-augment-source', default=256, type=int, metavar='N')
+    parser.add_argument('--iters', default=50, type=int, metavar='N', help='timed steps per scenario')
+    parser.add_argument('--warmup', default=10, type=int, metavar='N', help='untimed steps per scenario')
+    parser.add_argument('--device', type=str, default=default_device(), choices=['cuda', 'cpu'])
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS)
+    parser.add_argument('--compile', type=str, default='none', choices=compiled_step.MODES, help='compile the model or the whole step in the model and full scenarios (default: none)')
+    parser.add_argument('--compile-mode', type=str, default=None, help='torch.compile mode (default: reduce-overhead on a single GPU, else default)')
+    parser.add_argument('--compile-cache-dir', type=str, default=os.path.expanduser('~/.cache/imagenet_distributed_torch/inductor'), metavar='DIR')
+    parser.add_argument('--grad-sync', type=str, default='ddp', choices=grad_sync.MODES, help='gradient allreduce when run with several processes (default: ddp)')
+    parser.add_argument('--bucket-cap-mb', default=25, type=int, metavar='MB')
+    parser.add_argument('--grad-compression', type=str, default='none', choices=grad_sync.COMPRESSIONS)
+    parser.add_argument('--powersgd-rank', default=2, type=int, metavar='R')
+    parser.add_argument('--accum-steps', default=1, type=int, metavar='N')
+    parser.add_argument('--act-checkpoint', default=0, type=int, metavar='N', help='activation checkpointing segments per stage, at least 2 (default: 0, off)')
+    parser.add_argument('--output', type=str, default='', metavar='FILE', help='write results as JSON to FILE')
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    # under torchrun every process runs the scenarios, gradients are synchronized by
+    # --grad-sync and the images/sec reported by rank 0 are per process.
+    args.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    device = DeviceContext(args.device, local_rank)
+    device.set_current()
+    args.rank = 0
+    if args.distributed:
+        torch.distributed.init_process_group(backend=device.backend, init_method='env://')
+        args.rank = torch.distributed.get_rank()
+        args.world_size = torch.distributed.get_world_size()
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    if args.compile != 'none' or 'compile' in args.scenarios:
+        compiled_step.enable_cache(args.compile_cache_dir)
+
+    results = []
+    for name in args.scenarios:
+        result = SCENARIOS[name](args, device, memory_format)
+        result['scenario'] = name
+        results.append(result)
+        if args.rank != 0:
+            continue
+        print('{:<12} {:10.1f} images/sec  p50 {:8.2f} ms  p95 {:8.2f} ms  p99 {:8.2f} ms  warmup {:.2f} s'.format(
+              name, result['images_per_sec'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['warmup_s']))
+        if 'speedup' in result:
+            print('{:<12} {:10.1f} images/sec eager, {:.2f}x speedup compiled (warmup incl. compile {:.2f} s vs {:.2f} s)'.format(
+                  '', result['eager']['images_per_sec'], result['speedup'], result['warmup_s'], result['eager']['warmup_s']))
+
+    if args.output and args.rank == 0:
+        report = {
+            'config': vars(args),
+            'env': {
+                'torch': torch.__version__,
+                'host': platform.node(),
+                'cpus': os.cpu_count(),
+                'device': device.name(),
+            },
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
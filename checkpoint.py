@@ -0,0 +1,218 @@
+"""Asynchronous checkpointing.
+
+AsyncCheckpointer.save() only blocks for the copy of the state into (reused, pinned)
+host buffers. torch.save runs in a background thread, writes to a temporary file and
+renames it into place, so a crash never leaves a truncated checkpoint behind, and
+model_best.pth.tar is a hardlink to the checkpoint instead of a second full copy.
+
+With shard=True every rank writes a byte-balanced share of the model and optimizer
+tensors to <filename>.shard<rank>-of-<world_size>, which spreads the write bandwidth
+over all ranks. load_checkpoint() reads plain and sharded checkpoints alike, memory-mapped
+where torch supports it, so restarts only page in what they use.
+"""
+import glob
+import os
+import random
+import re
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+SHARD_SUFFIX = '.shard{}-of-{}'
+
+
+def _nbytes(obj):
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    return 0
+
+
+def _owners(values, world_size):
+    """Greedily give every value, largest first, to the rank with the fewest bytes so far"""
+    load = [0] * world_size
+    owners = [0] * len(values)
+    for i in sorted(range(len(values)), key=lambda i: -_nbytes(values[i])):
+        owners[i] = load.index(min(load))
+        load[owners[i]] += _nbytes(values[i])
+    return owners
+
+
+def shard_state(state, rank, world_size):
+    """The part of a checkpoint state written by rank; metadata goes to rank 0"""
+    shard = {}
+    if rank == 0:
+        shard.update((k, v) for k, v in state.items() if k not in ('state_dict', 'optimizer'))
+    model = list(state['state_dict'].items())
+    owners = _owners([v for _, v in model], world_size)
+    shard['state_dict'] = {k: v for (k, v), owner in zip(model, owners) if owner == rank}
+    optimizer = state['optimizer']
+    params = list(optimizer['state'].items())
+    owners = _owners([v for _, v in params], world_size)
+    shard['optimizer'] = {'state': {k: v for (k, v), owner in zip(params, owners) if owner == rank}}
+    if rank == 0:
+        shard['optimizer']['param_groups'] = optimizer['param_groups']
+    shard['shard'] = (rank, world_size, state['epoch'], state.get('step', 0))
+    return shard
+
+
+def merge_shards(shards):
+    state = {'state_dict': {}, 'optimizer': {'state': {}}}
+    tags = set()
+    for shard in shards:
+        tags.add(shard.pop('shard')[2:])
+        state['state_dict'].update(shard.pop('state_dict'))
+        optimizer = shard.pop('optimizer')
+        state['optimizer']['state'].update(optimizer['state'])
+        if 'param_groups' in optimizer:
+            state['optimizer']['param_groups'] = optimizer['param_groups']
+        state.update(shard)
+    if len(tags) != 1:
+        raise RuntimeError('checkpoint shards come from different steps: {}'.format(sorted(tags)))
+    return state
+
+
+class AsyncCheckpointer(object):
+    def __init__(self, shard=False, rank=0, world_size=1, device=None, blocking=False):
+        self.shard = shard
+        self.rank = rank
+        self.world_size = world_size
+        self.device = device
+        self.blocking = blocking
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def _snapshot(self, obj, key=()):
+        if torch.is_tensor(obj):
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                pin = self.device is not None and self.device.is_cuda
+                buf = self._buffers[key] = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=pin)
+            buf.copy_(obj.detach(), non_blocking=True)
+            return buf
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def wait(self):
+        """Block until the checkpoint in flight is on disk, re-raising its error if it failed"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, state, is_best, filename='checkpoint.pth.tar', best_filename='model_best.pth.tar'):
+        # the host buffers are reused, so the previous write has to be done with them.
+        self.wait()
+        if self.shard:
+            state = shard_state(state, self.rank, self.world_size)
+            suffix = SHARD_SUFFIX.format(self.rank, self.world_size)
+            filename, best_filename = filename + suffix, best_filename + suffix
+        state = self._snapshot(state)
+        if self.device is not None:
+            self.device.synchronize()
+
+        self._thread = threading.Thread(target=self._write, args=(state, is_best, filename, best_filename),
+                                        name='checkpoint-writer', daemon=True)
+        self._thread.start()
+        if self.blocking:
+            self.wait()
+
+    def _write(self, state, is_best, filename, best_filename):
+        try:
+            # unique per process: writers on other nodes may target the same file
+            tmp = '{}.tmp.{}'.format(filename, os.getpid())
+            torch.save(state, tmp)
+            os.replace(tmp, filename)
+            if is_best:
+                link_or_copy(filename, best_filename)
+        except BaseException as e:
+            self._error = e
+
+
+def link_or_copy(src, dst):
+    """Atomically point dst at the content of src, by a hardlink where the filesystem allows it"""
+    tmp = '{}.tmp.{}'.format(dst, os.getpid())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def shard_files(filename):
+    """The shard files of a sharded checkpoint, [] if there are none"""
+    first = glob.glob(glob.escape(filename) + SHARD_SUFFIX.format(0, '*'))
+    # skip the temporary files of shards still being written
+    first = [f for f in first if re.search(r'-of-\d+$', f)]
+    if not first:
+        return []
+    # leftovers of runs with another world size may be around, the newest one wins
+    first = max(first, key=os.path.getmtime)
+    world_size = int(re.search(r'-of-(\d+)$', first).group(1))
+    return [filename + SHARD_SUFFIX.format(r, world_size) for r in range(world_size)]
+
+
+def checkpoint_exists(filename):
+    return os.path.isfile(filename) or bool(shard_files(filename))
+
+
+def _load(filename, map_location):
+    try:
+        # mmap only maps the file, tensors are paged in once they are used
+        return torch.load(filename, map_location=map_location, mmap=True)
+    except (TypeError, RuntimeError):
+        # older torch, or a checkpoint written with the legacy (non-zip) format
+        return torch.load(filename, map_location=map_location)
+
+
+def load_checkpoint(filename, map_location=None):
+    """Load a checkpoint written by AsyncCheckpointer, sharded or not"""
+    if os.path.isfile(filename):
+        return _load(filename, map_location)
+    files = shard_files(filename)
+    if not files:
+        raise FileNotFoundError(filename)
+    return merge_shards([_load(f, map_location) for f in files])
+
+
+def model_state_dict(state_dict):
+    """A checkpoint's model state dict without the module. prefix of the DDP wrapper.
+
+    Checkpoints hold the unwrapped model's state, so they load with any world size;
+    older ones were saved from the DDP wrapper.
+    """
+    return {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+
+
+def rng_state():
+    """The RNG states of this process, to restore the random streams on resume"""
+    # numpy's key array is kept as a tensor, so the checkpoint still loads with weights_only
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+import torch.utils.data
+
+
+def _new_shared(shape, memory_format):
+    # allocate directly in shared memory, the same trick default_collate uses, so
+    # sending the batch back from a loader worker doesn't copy it once more.
+    numel = 1
+    for s in shape:
+        numel *= s
+    try:
+        storage = torch.UntypedStorage._new_shared(numel)
+        tensor = torch.empty(0, dtype=torch.uint8).set_(storage).view(shape)
+    except (AttributeError, RuntimeError):
+        tensor = torch.empty(shape, dtype=torch.uint8).share_memory_()
+    if memory_format == torch.channels_last:
+        # same bytes, NHWC strides
+        tensor = tensor.view(shape[0], shape[2], shape[3], shape[1]).permute(0, 3, 1, 2)
+    return tensor
+
+
+class FastCollate(object):
+    """Collates (PIL image or HWC uint8 array, target) samples into a uint8 NCHW batch, one copy per image.
+
+    Each image is written straight into its slot of the batch buffer through an NHWC
+    view, whatever memory_format the buffer has. Grayscale images broadcast over the
+    3 channels and the alpha plane of RGBA images is dropped by the same slice.
+
+    Inside loader workers the buffer is allocated in shared memory. In the main process
+    (num_workers=0) up to num_buffers buffers are recycled round-robin, optionally
+    pinned, so a consumer must be done with a batch before num_buffers more were made.
+    """
+    def __init__(self, memory_format=torch.contiguous_format, pin_memory=False, num_buffers=0):
+        self.memory_format = memory_format
+        self.pin_memory = pin_memory
+        self.num_buffers = num_buffers
+        self._buffers = []
+        self._next = 0
+
+    def __getstate__(self):
+        # workers never reuse buffers, don't ship them.
+        state = self.__dict__.copy()
+        state['_buffers'] = []
+        state['_next'] = 0
+        return state
+
+    def _alloc(self, shape):
+        tensor = torch.empty(shape, dtype=torch.uint8, memory_format=self.memory_format)
+        if self.pin_memory and torch.cuda.is_available():
+            tensor = tensor.pin_memory()
+        return tensor
+
+    def buffer(self, shape):
+        if torch.utils.data.get_worker_info() is not None:
+            return _new_shared(shape, self.memory_format)
+        if self.num_buffers <= 0:
+            return self._alloc(shape)
+
+        if len(self._buffers) < self.num_buffers:
+            self._buffers.append(self._alloc(shape))
+            return self._buffers[-1]
+        tensor = self._buffers[self._next]
+        self._next = (self._next + 1) % self.num_buffers
+        if tuple(tensor.shape) != tuple(shape):
+            # the last, smaller batch of an epoch
+            tensor = self._alloc(shape)
+        return tensor
+
+    def __call__(self, batch):
+        targets = torch.tensor([sample[1] for sample in batch], dtype=torch.int64)
+        img = batch[0][0]
+        h, w = img.shape[:2] if isinstance(img, np.ndarray) else (img.size[1], img.size[0])
+        tensor = self.buffer((len(batch), 3, h, w))
+
+        out = tensor.permute(0, 2, 3, 1).numpy()
+        for i, sample in enumerate(batch):
+            # (h, w) gray, (h, w, 3) RGB or (h, w, 4) RGBA -> (h, w, 1|3), broadcast to 3 channels
+            np.copyto(out[i], np.asarray(sample[0], dtype=np.uint8).reshape(h, w, -1)[:, :, :3])
+        return tensor, targets
@@ -0,0 +1,87 @@
+"""torch.compile for the training step.
+
+--compile picks what is compiled:
+    none    eager, the default
+    model   the model (its forward and, through AOTAutograd, its backward)
+    step    the whole step: forward and loss as one graph, its backward, and
+            the optimizer update
+
+The default --compile-mode is reduce-overhead on a single GPU, which captures
+the compiled step in CUDA graphs and replays them, so a step costs a few
+launches instead of one per kernel. Distributed, the DDP allreduces sit between
+the graphs, and CPU has no graph capture, so there it is default: inductor's
+fused kernels without capture. Every distinct input shape is a recompile, so in
+compile mode the train loader drops the last, smaller batch of the epoch.
+
+Compiled kernels and FX graphs are cached on disk in --compile-cache-dir, so only
+the first run with a given model and configuration pays the full compile time.
+
+In step mode the learning rate of every param group becomes a 0-d tensor that
+LRSchedule updates in place. A python float would be baked into the compiled
+optimizer and force a recompile whenever the rate changes.
+"""
+import os
+
+import torch
+
+MODES = ['none', 'model', 'step']
+
+
+def enable_cache(cache_dir):
+    """Keep inductor's compiled kernels and FX graphs in cache_dir across runs"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    try:
+        import torch._inductor.config as inductor_config
+    except ImportError:
+        return
+    # the config may have been imported (and read the environment) already
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+
+
+def default_mode(device, distributed=False):
+    return 'reduce-overhead' if device.is_cuda and not distributed else 'default'
+
+
+def forward_loss(model, criterion, precision):
+    """A function (input, target) -> (output, loss) for the forward part of a step"""
+    def forward(input, target):
+        with precision.autocast():
+            output = model(input)
+            loss = criterion(output, target)
+        return output, loss
+    return forward
+
+
+def compile_optimizer(optimizer, mode):
+    """Compile optimizer.step in place, with tensor learning rates"""
+    for param_group in optimizer.param_groups:
+        if not torch.is_tensor(param_group['lr']):
+            param_group['lr'] = torch.tensor(param_group['lr'])
+    step = optimizer.step
+
+    # a closure, so dynamo traces the update rather than the bound method's wrappers
+    @torch.compile(mode=mode, fullgraph=False)
+    def compiled_step(*args, **kwargs):
+        return step(*args, **kwargs)
+
+    optimizer.step = compiled_step
+    return optimizer
+
+
+def setup(model, criterion, optimizer, precision, device, compile='none', mode=None):
+    """The forward of a training step, as from forward_loss(), compiled as compile asks.
+
+    model itself stays uncompiled, for its state dict and for validation. In step
+    mode optimizer.step is compiled in place.
+    """
+    mode = mode or default_mode(device, torch.distributed.is_available() and torch.distributed.is_initialized())
+    if compile == 'model':
+        model = torch.compile(model, mode=mode, dynamic=False)
+    forward = forward_loss(model, criterion, precision)
+    if compile == 'step':
+        forward = torch.compile(forward, mode=mode, dynamic=False)
+        compile_optimizer(optimizer, mode)
+    return forward
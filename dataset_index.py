@@ -0,0 +1,156 @@
+"""Cached file index of an ImageFolder tree.
+
+datasets.ImageFolder walks and stats every file of its split on construction, on
+every rank and at every start, which on a network filesystem takes minutes and
+sends world_size duplicate scans to the metadata server. IndexedImageFolder reads
+the same samples from an index file instead: relative paths (one byte blob plus
+offsets), labels and file sizes as flat numpy arrays, a few tens of MB for
+ImageNet train.
+
+The index is keyed on a fingerprint of the split: the mtimes of its root and
+class directories, which change whenever a file is added, removed or renamed in
+them. Only rank 0 stats those and, if the index is missing or stale, walks the
+tree. The other ranks load the file rank 0 wrote, and ranks that can't see it
+(e.g. a node-local cache dir on another node) get the arrays broadcast from rank 0
+and write their own copy. The sample order is ImageFolder's, so indices (and e.g.
+CachedDataset entries) are interchangeable with datasets.ImageFolder's.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data
+import torchvision.datasets.folder as folder
+
+FIELDS = ('path_data', 'path_offsets', 'labels', 'sizes', 'classes')
+
+
+def fingerprint(root):
+    """mtimes of root and its class directories, as a short hex digest"""
+    stamps = [('.', os.stat(root).st_mtime_ns)]
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if entry.is_dir(follow_symlinks=True):
+            stamps.append((entry.name, entry.stat(follow_symlinks=True).st_mtime_ns))
+    return hashlib.sha1(json.dumps(stamps).encode()).hexdigest()[:16]
+
+
+def build_index(root):
+    """Walk root like ImageFolder does and return the index arrays"""
+    classes, class_to_idx = folder.find_classes(root)
+    samples = folder.make_dataset(root, class_to_idx, extensions=folder.IMG_EXTENSIONS)
+    paths = [os.path.relpath(path, root).encode() for path, _ in samples]
+    lengths = np.array([len(p) for p in paths], dtype=np.int64)
+    path_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=path_offsets[1:])
+    return {
+        'path_data': np.frombuffer(b''.join(paths), dtype=np.uint8),
+        'path_offsets': path_offsets,
+        'labels': np.array([label for _, label in samples], dtype=np.int64),
+        'sizes': np.array([os.stat(path).st_size for path, _ in samples], dtype=np.int64),
+        'classes': np.array(classes),
+    }
+
+
+def index_path(cache_dir, root):
+    return os.path.join(cache_dir, 'index_{}.npz'.format(
+        hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]))
+
+
+def load_index(path, fp):
+    """The index arrays in path if it was built for fingerprint fp, else None"""
+    try:
+        with np.load(path) as f:
+            if str(f['fingerprint']) != fp:
+                return None
+            return {k: f[k] for k in FIELDS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def store_index(path, fp, index):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    # np.savez appends .npz to names without it
+    tmp = '{}.tmp.{}.npz'.format(path, os.getpid())
+    np.savez(tmp, fingerprint=np.array(fp), **index)
+    os.replace(tmp, path)
+
+
+def shared_index(root, cache_dir, log=None):
+    """The index of root, built at most once by rank 0. A collective when distributed."""
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    path = index_path(cache_dir, root)
+
+    fp = None
+    index = None
+    if rank == 0:
+        fp = fingerprint(root)
+        index = load_index(path, fp)
+        if index is None:
+            if log is not None:
+                log("=> building the file index of '{}'".format(root))
+            index = build_index(root)
+            store_index(path, fp, index)
+            if log is not None:
+                log("=> {} samples indexed in {}".format(len(index['labels']), path))
+    if not distributed:
+        return index
+
+    fp = [fp]
+    dist.broadcast_object_list(fp, src=0)
+    fp = fp[0]
+    if rank != 0:
+        index = load_index(path, fp)
+    missing = torch.tensor([index is None], dtype=torch.int32)
+    if dist.get_backend() == 'nccl':
+        missing = missing.cuda()
+    dist.all_reduce(missing)
+    if missing.item() > 0:
+        # some ranks don't see rank 0's cache dir; send them the arrays
+        shipped = [index if rank == 0 else None]
+        dist.broadcast_object_list(shipped, src=0)
+        if index is None:
+            index = shipped[0]
+            store_index(path, fp, index)
+    return index
+
+
+class IndexedImageFolder(torch.utils.data.Dataset):
+    """Drop-in replacement for datasets.ImageFolder that reads its samples from a cached index"""
+    def __init__(self, root, transform=None, target_transform=None, cache_dir='', loader=folder.default_loader,
+                 log=None):
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+        self.loader = loader
+
+        index = shared_index(root, cache_dir, log=log)
+        self.path_data = index['path_data']
+        self.path_offsets = index['path_offsets']
+        self.labels = index['labels']
+        # encoded file sizes, e.g. to estimate decode cost without touching the files
+        self.sizes = index['sizes']
+        self.classes = [str(c) for c in index['classes']]
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.targets = self.labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def path(self, index):
+        start, end = self.path_offsets[index], self.path_offsets[index + 1]
+        return os.path.join(self.root, self.path_data[start:end].tobytes().decode())
+
+    def __getitem__(self, index):
+        img = self.loader(self.path(index))
+        target = int(self.labels[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
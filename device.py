@@ -0,0 +1,81 @@
+"""Device abstraction for the cuda/nccl and the cpu/gloo execution paths.
+
+Everything in the training loop that used to call into torch.cuda directly goes
+through a DeviceContext, so the whole train/validate/checkpoint flow also runs on
+CPU-only boxes, e.g. for CI or to benchmark the data pipeline:
+
+torchrun --nproc_per_node=4 torch_distributed_ddp_imagenet.py --device cpu -j 2
+"""
+import contextlib
+import platform
+
+import torch
+
+
+class DeviceContext(object):
+    def __init__(self, kind, index=0):
+        self.is_cuda = kind == 'cuda'
+        if self.is_cuda:
+            self.device = torch.device('cuda', index)
+        else:
+            self.device = torch.device('cpu')
+
+    @property
+    def backend(self):
+        return 'nccl' if self.is_cuda else 'gloo'
+
+    def name(self):
+        """The GPU model, or the CPU's on cpu"""
+        if self.is_cuda:
+            return torch.cuda.get_device_name(self.device)
+        return platform.processor() or platform.machine()
+
+    def set_current(self):
+        if self.is_cuda:
+            torch.cuda.set_device(self.device)
+
+    def synchronize(self):
+        if self.is_cuda:
+            torch.cuda.synchronize(self.device)
+
+    def new_stream(self):
+        """A side stream for host->device copies, None where copies are synchronous anyway"""
+        if self.is_cuda:
+            return torch.cuda.Stream(self.device)
+        return None
+
+    def stream(self, stream):
+        if stream is None:
+            return contextlib.nullcontext()
+        return torch.cuda.stream(stream)
+
+    def wait_stream(self, stream):
+        """Make the current stream wait for stream and return the current stream"""
+        if stream is None:
+            return None
+        current = torch.cuda.current_stream(self.device)
+        current.wait_stream(stream)
+        return current
+
+    def record_event(self, stream):
+        """An event marking the work queued on stream so far, None on cpu"""
+        if stream is None:
+            return None
+        event = torch.cuda.Event()
+        event.record(stream)
+        return event
+
+    def wait_event(self, event):
+        """Make the current stream wait for event and return the current stream"""
+        if event is None:
+            return None
+        current = torch.cuda.current_stream(self.device)
+        current.wait_event(event)
+        return current
+
+    def __repr__(self):
+        return str(self.device)
+
+
+def default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
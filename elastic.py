@@ -0,0 +1,59 @@
+"""Elastic training under torchrun.
+
+With --elastic the script expects to be started by torchrun with a rendezvous
+backend and a range of nodes, e.g.
+
+torchrun --nnodes=1:4 --nproc-per-node=4 --max-restarts=10 --rdzv-backend=c10d \
+    --rdzv-endpoint=host:29400 --rdzv-id=job torch_distributed_ddp_imagenet.py --elastic --checkpoint-dir ckpt
+
+When a node dies or joins, torchrun stops the workers of every node, forms a new
+group and starts them again. Each start is a fresh run of main(): the world size,
+sampler shards and the LR scaled by the effective batch (or, with
+--global-batch-size, the per-process batch) follow the new group, and the run
+resumes from the latest checkpoint in --checkpoint-dir. Checkpoints record how
+many samples of the epoch all ranks together consumed, so a mid-epoch
+checkpoint continues at the same point of the epoch for any world size, up to
+one global batch of repeats.
+
+Global rank 0 writes the checkpoints and ranks move between nodes from one start
+to the next, so --checkpoint-dir is required and has to be shared by all nodes.
+An explicit --resume only seeds the first start. The model is loaded before DDP
+wraps it, which broadcasts rank 0's weights, and every rank checks that it
+resumed at rank 0's epoch and step, failing the start otherwise.
+
+--checkpoint-shards can't be combined with --elastic: a node that dies while the
+shards are written leaves some of them from the step before, and every shard it
+wrote is gone with its disk unless --checkpoint-dir is shared. Rank 0 writes the
+whole checkpoint instead.
+
+For a local test, a file store replaces the TCP rendezvous endpoint, see
+elastic_smoke.py:
+
+torchrun --nnodes=1:2 --nproc-per-node=2 --rdzv-backend=c10d --rdzv-endpoint=/tmp/rdzv \
+    --rdzv-conf store_type=file --rdzv-id=smoke torch_distributed_ddp_imagenet.py --elastic --device cpu ...
+"""
+import os
+
+
+def restart_count():
+    """How often torchrun restarted the workers of this job so far"""
+    return int(os.environ.get('TORCHELASTIC_RESTART_COUNT', 0))
+
+
+def launched_by_torchrun():
+    return 'TORCHELASTIC_RUN_ID' in os.environ
+
+
+def resume_step(checkpoint, batch_size, world_size, accum_steps=1):
+    """The step of checkpoint's epoch to continue at with batch_size per process on world_size ranks.
+
+    Rounded down to a whole optimizer step, so a few samples may be seen twice,
+    never skipped.
+    """
+    step = checkpoint.get('step', 0)
+    samples = checkpoint.get('samples')
+    if samples is None or step == 0:
+        # written before samples were recorded, or at the start of the epoch
+        return step
+    step = samples // (batch_size * world_size)
+    return step - step % accum_steps
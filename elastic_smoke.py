@@ -0,0 +1,102 @@
+"""Local smoke test of --elastic: two torchrun agents on cpu, one of them dies.
+
+Writes a tiny ImageFolder of random JPEGs, starts two torchrun agents as two
+"nodes" of a --nnodes=1:2 job that meet through a file-based rendezvous, kills
+one agent (and its workers) once the first mid-epoch checkpoint is on disk, and
+checks that the other one re-forms the group alone, resumes from that checkpoint
+with the smaller world size and finishes the run.
+
+python elastic_smoke.py --workdir /tmp/elastic_smoke
+"""
+import argparse
+import glob
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'torch_distributed_ddp_imagenet.py')
+
+
+def write_dataset(root, classes=2, images=16, size=80, seed=0):
+    rng = np.random.RandomState(seed)
+    for split in ('train', 'val'):
+        for c in range(classes):
+            d = os.path.join(root, split, 'class{}'.format(c))
+            os.makedirs(d, exist_ok=True)
+            for i in range(images):
+                Image.fromarray(rng.randint(0, 256, (size, size, 3), dtype=np.uint8)).save(
+                    os.path.join(d, '{}.jpg'.format(i)))
+
+
+def agent(args, name, data, checkpoint_dir, rdzv_file):
+    cwd = os.path.join(args.workdir, name)
+    os.makedirs(cwd, exist_ok=True)
+    cmd = [sys.executable, '-m', 'torch.distributed.run',
+           '--nnodes=1:2', '--nproc-per-node={}'.format(args.nproc_per_node), '--max-restarts=3',
+           '--rdzv-backend=c10d', '--rdzv-endpoint={}'.format(rdzv_file), '--rdzv-id=elastic_smoke',
+           '--rdzv-conf', 'store_type=file,join_timeout=120,last_call_timeout=5',
+           SCRIPT, '--elastic', '--device', 'cpu', '--data', data, '--index-cache', '',
+           '-a', args.arch, '-b', '4', '-j', '0', '--epochs', str(args.epochs), '--print-freq', '1',
+           '--checkpoint-steps', '2', '--sync-checkpoint', '--checkpoint-dir', checkpoint_dir]
+    out = open(os.path.join(cwd, 'agent.out'), 'w')
+    # its own session, so the agent and its workers can be killed together
+    return subprocess.Popen(cmd, cwd=cwd, stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='elastic training smoke test')
+    parser.add_argument('--workdir', type=str, default='', metavar='DIR', help='(default: a new temporary directory)')
+    parser.add_argument('--nproc-per-node', default=1, type=int, metavar='N')
+    parser.add_argument('--arch', type=str, default='resnet18')
+    parser.add_argument('--epochs', default=3, type=int, metavar='N')
+    parser.add_argument('--timeout', default=900, type=float, metavar='S')
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='elastic_smoke_')
+    data = os.path.join(args.workdir, 'data')
+    checkpoint_dir = os.path.join(args.workdir, 'checkpoints')
+    rdzv_file = os.path.join(args.workdir, 'rdzv')
+    if os.path.exists(rdzv_file):
+        os.remove(rdzv_file)
+    write_dataset(data)
+
+    survivor = agent(args, 'agent0', data, checkpoint_dir, rdzv_file)
+    victim = agent(args, 'agent1', data, checkpoint_dir, rdzv_file)
+    deadline = time.time() + args.timeout
+    checkpoint = os.path.join(checkpoint_dir, 'checkpoint.pth.tar')
+    while not os.path.exists(checkpoint):
+        if time.time() > deadline or survivor.poll() is not None or victim.poll() is not None:
+            raise SystemExit('FAIL: no checkpoint was written, see {}/agent*/agent.out'.format(args.workdir))
+        time.sleep(0.5)
+    print('=> checkpoint written, killing agent1')
+    os.killpg(victim.pid, signal.SIGKILL)
+    victim.wait()
+
+    try:
+        code = survivor.wait(timeout=max(deadline - time.time(), 1))
+    except subprocess.TimeoutExpired:
+        os.killpg(survivor.pid, signal.SIGKILL)
+        raise SystemExit('FAIL: agent0 did not finish, see {}/agent0/agent.out'.format(args.workdir))
+
+    logs = ''
+    for path in glob.glob(os.path.join(args.workdir, 'agent0', 'log_*.txt')):
+        with open(path) as f:
+            logs += f.read()
+    resumed = 'world size changed from {} to {}'.format(2 * args.nproc_per_node, args.nproc_per_node) in logs
+    print('=> agent0 exited with {}, resumed with the smaller world size: {}'.format(code, resumed))
+    if code != 0 or not resumed:
+        raise SystemExit('FAIL: see {}/agent0'.format(args.workdir))
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Gradient synchronization between ranks.
+
+--grad-sync picks how gradients are allreduced:
+    apex        apex DDP(delay_allreduce=True): one allreduce after the whole backward
+                pass (the original behaviour, cuda only)
+    apex-overlap apex DDP allreducing buckets of --bucket-cap-mb while backward runs
+    ddp         torch DDP, buckets of --bucket-cap-mb allreduced while backward runs,
+                on nccl and gloo alike, optionally compressed by a comm hook
+
+--grad-compression (ddp only) casts buckets to fp16/bf16 for the allreduce, or
+replaces it by PowerSGD's low-rank approximation with error feedback.
+
+no_sync(model) skips the allreduce of the micro-steps of gradient accumulation
+for every wrapper, so only the last micro-batch of an optimizer step communicates.
+"""
+import contextlib
+
+import torch
+import torch.distributed.algorithms.ddp_comm_hooks.default_hooks as default_hooks
+import torch.distributed.algorithms.ddp_comm_hooks.powerSGD_hook as powerSGD
+
+MODES = ['apex', 'apex-overlap', 'ddp']
+COMPRESSIONS = ['none', 'fp16', 'bf16', 'powersgd']
+
+
+def wrap(model, mode, device, bucket_cap_mb=25, compression='none', powersgd_rank=2, powersgd_start_iter=10):
+    """Wrap model for distributed training, see the module docstring for the modes"""
+    if compression != 'none' and mode != 'ddp':
+        raise ValueError('--grad-compression {} needs --grad-sync ddp'.format(compression))
+
+    if mode in ('apex', 'apex-overlap'):
+        from apex.parallel import DistributedDataParallel as DDP
+        if mode == 'apex':
+            return DDP(model, delay_allreduce=True)
+        # apex counts its message size in elements, not bytes
+        numel = bucket_cap_mb * (1 << 20) // next(model.parameters()).element_size()
+        return DDP(model, message_size=numel)
+
+    device_ids = [device.device.index] if device.is_cuda else None
+    model = torch.nn.parallel.DistributedDataParallel(
+        model, device_ids=device_ids, bucket_cap_mb=bucket_cap_mb, gradient_as_bucket_view=True)
+    if compression == 'fp16':
+        model.register_comm_hook(None, default_hooks.fp16_compress_hook)
+    elif compression == 'bf16':
+        model.register_comm_hook(None, default_hooks.bf16_compress_hook)
+    elif compression == 'powersgd':
+        state = powerSGD.PowerSGDState(process_group=None, matrix_approximation_rank=powersgd_rank,
+                                       start_powerSGD_iter=powersgd_start_iter)
+        model.register_comm_hook(state, powerSGD.powerSGD_hook)
+    return model
+
+
+@contextlib.contextmanager
+def _apex_no_sync(model):
+    model.disable_allreduce()
+    try:
+        yield
+    finally:
+        model.enable_allreduce()
+
+
+def no_sync(model):
+    """Context manager under which backward only accumulates gradients locally.
+
+    Torch DDP decides in forward whether the next backward syncs, so forward and
+    backward both have to run under it.
+    """
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.no_sync()
+    if hasattr(model, 'disable_allreduce'):
+        return _apex_no_sync(model)
+    return contextlib.nullcontext()
@@ -0,0 +1,144 @@
+"""Cache for the output of deterministic transforms.
+
+The val pipeline (Resize + CenterCrop) produces the same crop for every image in
+every epoch, so it only has to be decoded once. CachedDataset keeps the uint8 HWC
+crops in a memory-mapped file on disk, shared by all loader workers and ranks on a
+host and kept across runs, plus a small in-RAM LRU tier per loader process.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.utils.data
+from PIL import Image
+
+HITS_RAM, HITS_DISK, MISSES, EVICTIONS = range(4)
+
+
+def _create(path, nbytes):
+    # create a sparse, zero-filled file atomically: several ranks on a host may race here.
+    if os.path.exists(path):
+        return
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.truncate(nbytes)
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+
+
+class CachedDataset(torch.utils.data.Dataset):
+    """Caches dataset[i][0] as a size x size x 3 uint8 array.
+
+    dataset must apply a deterministic transform that yields size x size RGB images
+    and expose .targets, so that a hit never touches the image file. transform, if
+    given, is applied on top of the cached image (e.g. random crops of pre-resized
+    train images); without it the cached array itself is returned, which FastCollate
+    copies straight into the batch.
+
+    ram_bytes is the budget of the in-RAM tier, split evenly over num_workers loader
+    processes. The tier lives as long as the worker does, so it pays off across epochs
+    with persistent workers or num_workers=0.
+    """
+    def __init__(self, dataset, cache_dir, size, transform=None, ram_bytes=0, num_workers=0):
+        self.dataset = dataset
+        self.targets = dataset.targets
+        self.size = size
+        self.transform = transform
+        self.ram_budget = ram_bytes
+        self.ram_bytes = ram_bytes // max(num_workers, 1)
+
+        # the cache is only valid for this exact dataset and transform
+        key = '{}|{}|{}|{}'.format(getattr(dataset, 'root', ''), len(dataset), size, dataset.transform)
+        name = hashlib.sha1(key.encode()).hexdigest()[:16]
+        os.makedirs(cache_dir, exist_ok=True)
+        self.data_file = os.path.join(cache_dir, name + '.u8')
+        self.valid_file = os.path.join(cache_dir, name + '.valid')
+        _create(self.data_file, len(dataset) * size * size * 3)
+        _create(self.valid_file, len(dataset))
+
+        # one row of counters per loader process, row 0 is the main process
+        self.counters = torch.zeros(num_workers + 1, 4, dtype=torch.int64).share_memory_()
+        # opened / filled lazily in every loader process
+        self._data = None
+        self._valid = None
+        self._lru = OrderedDict()
+        self._lru_bytes = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_data=None, _valid=None, _lru=OrderedDict(), _lru_bytes=0)
+        return state
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _open(self):
+        if self._data is None:
+            self._data = np.memmap(self.data_file, dtype=np.uint8, mode='r+',
+                                   shape=(len(self.dataset), self.size, self.size, 3))
+            self._valid = np.memmap(self.valid_file, dtype=np.uint8, mode='r+')
+
+    def _count(self, counter):
+        info = torch.utils.data.get_worker_info()
+        row = 0 if info is None else min(info.id + 1, len(self.counters) - 1)
+        self.counters[row, counter] += 1
+
+    def _remember(self, index, arr):
+        if arr.nbytes > self.ram_bytes:
+            return
+        self._lru[index] = np.array(arr)
+        self._lru_bytes += arr.nbytes
+        while self._lru_bytes > self.ram_bytes:
+            _, evicted = self._lru.popitem(last=False)
+            self._lru_bytes -= evicted.nbytes
+            self._count(EVICTIONS)
+
+    def _load(self, index):
+        arr = self._lru.get(index)
+        if arr is not None:
+            self._lru.move_to_end(index)
+            self._count(HITS_RAM)
+            return arr
+
+        self._open()
+        if self._valid[index]:
+            arr = self._data[index]
+            self._count(HITS_DISK)
+        else:
+            img, _ = self.dataset[index]
+            arr = np.asarray(img, dtype=np.uint8)
+            if arr.shape != (self.size, self.size, 3):
+                raise ValueError('cached transform must yield {0}x{0} RGB images, got shape {1}'
+                                 .format(self.size, arr.shape))
+            self._data[index] = arr
+            # flag the slot only once its data is in place
+            self._valid[index] = 1
+            self._count(MISSES)
+        if self.ram_bytes > 0:
+            self._remember(index, arr)
+        return arr
+
+    def __getitem__(self, index):
+        arr = self._load(index)
+        target = self.targets[index]
+        if self.transform is not None:
+            return self.transform(Image.fromarray(np.asarray(arr))), target
+        return arr, target
+
+    def stats(self):
+        hits_ram, hits_disk, misses, evictions = self.counters.sum(0).tolist()
+        return {'hits_ram': hits_ram, 'hits_disk': hits_disk, 'misses': misses, 'evictions': evictions}
+
+    def reset_stats(self):
+        self.counters.zero_()
+
+    def set_num_workers(self, num_workers):
+        """Re-split the RAM budget and the counters for num_workers loader processes (resets the stats)"""
+        self.ram_bytes = self.ram_budget // max(num_workers, 1)
+        self.counters = torch.zeros(num_workers + 1, 4, dtype=torch.int64).share_memory_()
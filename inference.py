@@ -0,0 +1,237 @@
+"""Batch inference: top-k predictions for large image dumps.
+
+Loads a training checkpoint (plain or sharded, --arch from the checkpoint) or
+torchvision's pretrained weights, traces (or torch.compiles) the model for
+inference and scores every image of a directory tree or of a packed split
+(packed_dataset.py) with the val preprocessing. The images are split into
+--procs contiguous ranges, one process each: one per GPU on cuda, on cpu each
+with its share of the cores. Every process streams its range through its own
+DataLoader and PrefetchQueue with large batches under torch.inference_mode and
+writes its rows of two memory-mapped .npy files:
+
+    <output>.classes.npy    int32 (images, k), the top-k class indices
+    <output>.scores.npy     float32 (images, k), their softmax probabilities
+    <output>.paths.txt      the image of every row, for directory input
+
+python inference.py --checkpoint model_best.pth.tar --input /data/dump --output preds -b 512 --procs 4
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.utils.data
+import torchvision.datasets.folder as folder
+import torchvision.models as models
+import torchvision.transforms as transforms
+
+from checkpoint import load_checkpoint, model_state_dict
+from collate import FastCollate
+from device import DeviceContext, default_device
+from loader_autotune import available_cpus
+from packed_dataset import PackedDataset
+from precision import PRECISIONS, MixedPrecision
+from prefetch import PrefetchQueue
+
+
+class ImageList(torch.utils.data.Dataset):
+    """Images by path; the target of a sample is its index, i.e. its output row"""
+    def __init__(self, paths, transform=None):
+        self.paths = paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        img = folder.default_loader(self.paths[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, index
+
+
+class Indexed(torch.utils.data.Dataset):
+    """dataset with every sample's label replaced by its index"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset[index][0], index
+
+
+def list_images(root):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        dirnames.sort()
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                     if folder.has_file_allowed_extension(f, folder.IMG_EXTENSIONS))
+    return paths
+
+
+def make_dataset(args, paths=None):
+    transform = transforms.Compose([
+        transforms.Resize(args.val_size),
+        transforms.CenterCrop(args.crop_size),
+    ])
+    if args.input_format == 'packed':
+        return Indexed(PackedDataset(args.input, transform))
+    return ImageList(paths, transform)
+
+
+def load_model(args, device, memory_format):
+    if args.checkpoint:
+        checkpoint = load_checkpoint(args.checkpoint, map_location='cpu')
+        model = models.__dict__[args.arch or checkpoint['arch']]()
+        model.load_state_dict(model_state_dict(checkpoint['state_dict']))
+    else:
+        model = models.__dict__[args.arch or 'resnet18'](pretrained=True)
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return model.to(device.device, memory_format=memory_format).eval()
+
+
+def compile_model(model, args, device, precision, memory_format):
+    if args.compile == 'trace':
+        example = torch.randn(args.batch_size, 3, args.crop_size, args.crop_size, device=device.device)
+        example = example.contiguous(memory_format=memory_format)
+        with torch.no_grad(), precision.autocast():
+            model = torch.jit.freeze(torch.jit.trace(model, example))
+    elif args.compile == 'compile':
+        model = torch.compile(model)
+    return model
+
+
+def run(proc, args, size, results):
+    """Score rows [start, end) of the output, the share of process proc"""
+    start, end = size * proc // args.procs, size * (proc + 1) // args.procs
+    device = DeviceContext(args.device, proc)
+    device.set_current()
+    if not device.is_cuda:
+        torch.set_num_threads(args.threads or max(available_cpus() // args.procs, 1))
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    precision = MixedPrecision(args.precision, device)
+
+    paths = None
+    if args.input_format == 'dir':
+        with open(args.output + '.paths.txt') as f:
+            paths = f.read().splitlines()
+    dataset = torch.utils.data.Subset(make_dataset(args, paths), range(start, end))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+                                         num_workers=args.workers, collate_fn=FastCollate(memory_format))
+    model = compile_model(load_model(args, device, memory_format), args, device, precision, memory_format)
+    classes = np.load(args.output + '.classes.npy', mmap_mode='r+')
+    scores = np.load(args.output + '.scores.npy', mmap_mode='r+')
+
+    def write(pending):
+        rows, top_scores, top_classes = (t.cpu().numpy() for t in pending)
+        classes[rows] = top_classes
+        scores[rows] = top_scores
+
+    t_start = time.perf_counter()
+    t_first = None
+    images = 0
+    # images after the first batch, the ones the steady-state time covers
+    steady_images = 0
+    pending = None
+    prefetcher = PrefetchQueue(loader, device, args.prefetch_depth)
+    with torch.inference_mode(), precision.autocast():
+        while True:
+            input, rows = prefetcher.next()
+            if input is None:
+                break
+            top_scores, top_classes = model(input).float().softmax(1).topk(args.topk, 1)
+            # write the batch before, whose results are ready by now, so the host
+            # never waits for the batch just queued on the device
+            if pending is not None:
+                write(pending)
+            pending = (rows, top_scores, top_classes)
+            images += input.size(0)
+            if t_first is None:
+                t_first = time.perf_counter()
+            else:
+                steady_images += input.size(0)
+    if pending is not None:
+        write(pending)
+    device.synchronize()
+    classes.flush()
+    scores.flush()
+    t_end = time.perf_counter()
+    results.put({'proc': proc, 'images': images, 'steady_images': steady_images, 'seconds': t_end - t_start,
+                 'steady_seconds': t_end - (t_first or t_end), 'prefetch': prefetcher.stats()})
+
+
+def parse():
+    model_names = sorted(name for name in models.__dict__ if name.islower() and not name.startswith("__") and callable(models.__dict__[name]))
+
+    parser = argparse.ArgumentParser(description='ImageNet batch inference')
+    parser.add_argument('--input', type=str, required=True, metavar='DIR', help='image tree, or a packed split directory with --input-format packed')
+    parser.add_argument('--input-format', type=str, default='dir', choices=['dir', 'packed'])
+    parser.add_argument('--output', type=str, required=True, metavar='PREFIX', help='writes PREFIX.classes.npy, PREFIX.scores.npy (and PREFIX.paths.txt)')
+    parser.add_argument('--checkpoint', type=str, default='', metavar='PATH', help="training checkpoint (default: torchvision's pretrained weights)")
+    parser.add_argument('--arch', '-a', metavar='ARCH', default='', choices=[''] + model_names, help="(default: the checkpoint's, resnet18 without one)")
+    parser.add_argument('--topk', default=5, type=int, metavar='K')
+    parser.add_argument('-b', '--batch-size', default=512, type=int, metavar='N')
+    parser.add_argument('-j', '--workers', default=8, type=int, metavar='N', help='loader workers per process (default: 8)')
+    parser.add_argument('--prefetch-depth', default=2, type=int, metavar='N')
+    parser.add_argument('--device', type=str, default=default_device(), choices=['cuda', 'cpu'])
+    parser.add_argument('--procs', default=0, type=int, metavar='N', help='processes, one per device on cuda (default: all GPUs on cuda, 1 on cpu)')
+    parser.add_argument('--threads', default=0, type=int, metavar='N', help='intra-op threads per process on cpu (default: cpus / --procs)')
+    parser.add_argument('--compile', type=str, default='trace', choices=['none', 'trace', 'compile'], help='trace: torch.jit.trace + freeze, compile: torch.compile (default: trace)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS)
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--crop-size', default=224, type=int, metavar='N')
+    parser.add_argument('--val-size', default=256, type=int, metavar='N')
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    if args.procs <= 0:
+        args.procs = torch.cuda.device_count() if args.device == 'cuda' else 1
+
+    if args.input_format == 'dir':
+        paths = list_images(args.input)
+        with open(args.output + '.paths.txt', 'w') as f:
+            f.write(''.join(p + '\n' for p in paths))
+        size = len(paths)
+    else:
+        size = len(make_dataset(args))
+    # created here, every process fills its own rows; -1 marks rows never written
+    classes = np.lib.format.open_memmap(args.output + '.classes.npy', mode='w+', dtype=np.int32, shape=(size, args.topk))
+    classes[:] = -1
+    np.lib.format.open_memmap(args.output + '.scores.npy', mode='w+', dtype=np.float32, shape=(size, args.topk))
+    del classes
+
+    start = time.perf_counter()
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    if args.procs == 1:
+        run(0, args, size, results)
+    else:
+        procs = [ctx.Process(target=run, args=(proc, args, size, results)) for proc in range(args.procs)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        failed = [p.exitcode for p in procs if p.exitcode != 0]
+        if failed:
+            raise RuntimeError('{} inference processes failed, exit codes {}'.format(len(failed), failed))
+    elapsed = time.perf_counter() - start
+
+    stats = sorted((results.get() for _ in range(args.procs)), key=lambda r: r['proc'])
+    for r in stats:
+        print('=> process {proc}: {images} images in {seconds:.1f} s, {0:.1f} images/sec after the first batch, '
+              'starved {1} times'.format(r['steady_images'] / max(r['steady_seconds'], 1e-9), r['prefetch']['starved'], **r))
+    images = sum(r['images'] for r in stats)
+    steady = sum(r['steady_images'] / max(r['steady_seconds'], 1e-9) for r in stats)
+    print('=> {} images in {:.1f} s: {:.1f} images/sec end to end, {:.1f} images/sec steady state'.format(
+          images, elapsed, images / elapsed, steady))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Per-stage step timings.
+
+StageTimer records how long every stage of a step (data wait, forward, backward,
+optimizer step, allreduce) took, in a fixed-size ring buffer per stage, so it can
+stay on for a whole run. Disabled, timer.stage() hands back a shared no-op context
+manager and costs about as much as the with statement itself.
+
+The timings aggregate over ranks (summary()/gather_summaries()) and export as a
+Chrome trace (chrome://tracing, https://ui.perfetto.dev) or as JSON.
+"""
+import contextlib
+import json
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class _Stage(object):
+    __slots__ = ('timer', 'index', 'name', 'start')
+
+    def __init__(self, timer, index, name):
+        self.timer = timer
+        self.index = index
+        self.name = name
+        self.start = 0.
+
+    def __enter__(self):
+        if self.timer.nvtx:
+            torch.cuda.nvtx.range_push(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timer = self.timer
+        if timer.sync:
+            timer.device.synchronize()
+        end = time.perf_counter()
+        if timer.record:
+            timer._add(self.index, self.start, end - self.start)
+        if timer.nvtx:
+            torch.cuda.nvtx.range_pop()
+        return False
+
+
+class StageTimer(object):
+    """Ring-buffered per-stage timings of the last capacity occurrences of every stage.
+
+    record: keep timings, nvtx: also emit nvtx ranges for nsys/nvprof, sync: synchronize
+    device at the end of every stage, so stages time their kernels and not just their
+    launches (at the cost of the overlap between them).
+    """
+    def __init__(self, record=False, nvtx=False, sync=False, device=None, capacity=4096, rank=0):
+        self.record = record
+        self.nvtx = nvtx
+        self.sync = sync and device is not None
+        self.device = device
+        self.capacity = capacity
+        self.rank = rank
+        self.enabled = record or nvtx
+        self.step = 0
+        self._stages = {}
+        self._names = []
+        self.reset()
+        # wall clock base, so traces of different ranks line up
+        self._t0 = time.perf_counter()
+        self._t0_wall = time.time()
+
+    def reset(self):
+        n = len(self._names)
+        self._starts = np.zeros((n, self.capacity))
+        self._durations = np.zeros((n, self.capacity))
+        self._steps = np.zeros((n, self.capacity), dtype=np.int64)
+        self._counts = [0] * n
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages[name] = _Stage(self, len(self._names), name)
+            self._names.append(name)
+            grow = np.zeros((1, self.capacity))
+            self._starts = np.concatenate([self._starts, grow])
+            self._durations = np.concatenate([self._durations, grow])
+            self._steps = np.concatenate([self._steps, grow.astype(np.int64)])
+            self._counts.append(0)
+        return stage
+
+    def _add(self, index, start, duration):
+        slot = self._counts[index] % self.capacity
+        self._starts[index, slot] = start
+        self._durations[index, slot] = duration
+        self._steps[index, slot] = self.step
+        self._counts[index] += 1
+
+    def _window(self, index):
+        n = min(self._counts[index], self.capacity)
+        return self._starts[index, :n], self._durations[index, :n], self._steps[index, :n]
+
+    def summary(self):
+        """{stage: {count, mean_ms, p50_ms, p95_ms, max_ms}} over the buffered window"""
+        result = {}
+        for index, name in enumerate(self._names):
+            _, durations, _ = self._window(index)
+            if len(durations) == 0:
+                continue
+            ms = durations * 1000.
+            result[name] = {
+                'count': self._counts[index],
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p95_ms': float(np.percentile(ms, 95)),
+                'max_ms': float(ms.max()),
+            }
+        return result
+
+    def gather_summaries(self):
+        """summary() of every rank, as a list indexed by rank (collective call)"""
+        summary = self.summary()
+        if not (dist.is_available() and dist.is_initialized()):
+            return [summary]
+        summaries = [None] * dist.get_world_size()
+        dist.all_gather_object(summaries, summary)
+        return summaries
+
+    def chrome_trace(self):
+        events = []
+        for index, name in enumerate(self._names):
+            starts, durations, steps = self._window(index)
+            for start, duration, step in zip(starts, durations, steps):
+                events.append({
+                    'name': name, 'ph': 'X', 'pid': self.rank, 'tid': 0,
+                    'ts': (self._t0_wall + start - self._t0) * 1e6,
+                    'dur': duration * 1e6,
+                    'args': {'step': int(step)},
+                })
+        events.sort(key=lambda e: e['ts'])
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def format_summaries(summaries):
+    """One log line per stage: mean over ranks and the slowest rank's mean and p95"""
+    lines = []
+    names = []
+    for summary in summaries:
+        names.extend(name for name in summary if name not in names)
+    for name in names:
+        per_rank = [(rank, s[name]) for rank, s in enumerate(summaries) if name in s]
+        mean = sum(s['mean_ms'] for _, s in per_rank) / len(per_rank)
+        slowest, s = max(per_rank, key=lambda r: r[1]['mean_ms'])
+        lines.append(' * stage {:<10} mean {:8.2f} ms  slowest rank {} mean {:8.2f} ms p95 {:8.2f} ms'
+                     .format(name, mean, slowest, s['mean_ms'], s['p95_ms']))
+    return lines
@@ -0,0 +1,226 @@
+"""Picks num_workers, prefetch_factor and persistent_workers for the train loader.
+
+A fixed -j over- or undersubscribes depending on the host: per rank there are
+only cpus / local world size cores to go around, and how many workers a model
+needs depends on how fast its step is. autotune() measures both. It times a few
+training steps on synthetic input, then probes the real dataset and collate_fn
+with a growing number of workers and prefetch factors, smallest first, and keeps
+the first configuration whose loader rate covers the step rate with some
+headroom. All ranks of a node probe at the same time, so the probes see the same
+CPU contention as training, and every rank applies the slowest rank's verdict.
+
+The result is cached in a JSON file under a fingerprint of the host, the launch
+layout and the dataset, so later launches with the same setup skip the probes.
+"""
+import hashlib
+import json
+import os
+import platform
+import time
+
+import torch
+import torch.distributed as dist
+import torch.utils.data
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def fingerprint(dataset, batch_size, **extra):
+    """What the best loader configuration depends on, as a JSON-able dict"""
+    inner = getattr(dataset, 'dataset', dataset)
+    info = {
+        'host': platform.node(),
+        'cpus': available_cpus(),
+        'local_world_size': int(os.environ.get('LOCAL_WORLD_SIZE', 1)),
+        'dataset': type(dataset).__name__,
+        'root': getattr(inner, 'root', ''),
+        'len': len(dataset),
+        'transform': repr(getattr(dataset, 'transform', None)),
+        'batch_size': batch_size,
+    }
+    if inner is not dataset:
+        # e.g. CachedDataset, whose inner transform decides what is cached
+        info['inner_transform'] = repr(getattr(inner, 'transform', None))
+    info.update({k: str(v) for k, v in extra.items()})
+    return info
+
+
+def _key(info):
+    return hashlib.sha1(json.dumps(info, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_cached(path, info):
+    try:
+        with open(path) as f:
+            entry = json.load(f).get(_key(info))
+    except (OSError, ValueError):
+        return None
+    return entry['config'] if entry else None
+
+
+def store(path, info, config, probes):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[_key(info)] = {'fingerprint': info, 'config': config, 'probes': probes,
+                         'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = '{}.tmp.{}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, path)
+
+
+def measure_step_rate(step, batch_size, steps=10, warmup=3, device=None):
+    """Images/sec of step(), a callable running one training step on a fixed batch"""
+    for _ in range(warmup):
+        step()
+    if device is not None:
+        device.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device is not None:
+        device.synchronize()
+    return steps * batch_size / (time.perf_counter() - start)
+
+
+def _loader(dataset, indices, batch_size, collate_fn, num_workers, prefetch_factor, persistent_workers):
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=indices,
+                                       num_workers=num_workers, collate_fn=collate_fn, **kwargs)
+
+
+def _drain(loader):
+    """(seconds to the first batch, images/sec after it) of one pass over loader"""
+    start = time.perf_counter()
+    it = iter(loader)
+    next(it)
+    t_first = time.perf_counter()
+    images = 0
+    for input, _ in it:
+        images += input.size(0)
+    rate = images / max(time.perf_counter() - t_first, 1e-9)
+    return t_first - start, rate
+
+
+def _all_ranks(value, op):
+    if dist.is_available() and dist.is_initialized():
+        t = torch.tensor([value], dtype=torch.float64)
+        if dist.get_backend() == 'nccl':
+            t = t.cuda()
+        dist.all_reduce(t, op=op)
+        value = t.item()
+    return value
+
+
+def candidates(max_workers, prefetch_factors=(2, 4)):
+    """(num_workers, prefetch_factor) pairs, smallest first"""
+    workers = []
+    w = 1
+    while w < max_workers:
+        workers.append(w)
+        w *= 2
+    workers.append(max_workers)
+    return [(w, pf) for w in workers for pf in prefetch_factors]
+
+
+def probe(dataset, collate_fn, batch_size, target_rate, batches=20, headroom=1.1,
+          max_workers=None, seed=0, log=None):
+    """Smallest loader configuration that sustains target_rate images/sec on every rank.
+
+    Returns (config, probes): config has num_workers, prefetch_factor and
+    persistent_workers, probes the measurements behind it. A collective when
+    distributed: every rank has to call it with the same arguments.
+    """
+    if max_workers is None:
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        max_workers = max(available_cpus() // local_world_size, 1)
+    rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    # fresh samples for every probe, so earlier probes don't warm the page cache for later ones
+    g = torch.Generator()
+    g.manual_seed(seed * 1000 + rank)
+    order = torch.randperm(len(dataset), generator=g).tolist()
+    per_probe = batches * batch_size
+    offset = 0
+
+    def next_indices():
+        nonlocal offset
+        indices = [order[(offset + j) % len(order)] for j in range(per_probe)]
+        offset += per_probe
+        return indices
+
+    probes = []
+    best = None
+    for num_workers, prefetch_factor in candidates(max_workers):
+        if dist.is_available() and dist.is_initialized():
+            dist.barrier()
+        startup, rate = _drain(_loader(dataset, next_indices(), batch_size, collate_fn,
+                                       num_workers, prefetch_factor, False))
+        rate = _all_ranks(rate, dist.ReduceOp.MIN)
+        startup = _all_ranks(startup, dist.ReduceOp.MAX)
+        probes.append({'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                       'images_per_sec': rate, 'startup_s': startup})
+        if log is not None:
+            log('=> loader probe: {} workers, prefetch factor {}: {:.1f} images/sec, first batch after {:.2f} s'
+                .format(num_workers, prefetch_factor, rate, startup))
+        if best is None or rate > best['images_per_sec']:
+            best = probes[-1]
+        if rate >= target_rate * headroom:
+            best = probes[-1]
+            break
+
+    # persistent workers trade memory for not re-forking every epoch; keep them if a
+    # second pass over a persistent loader starts measurably faster than a fresh one
+    loader = _loader(dataset, next_indices(), batch_size, collate_fn,
+                     best['num_workers'], best['prefetch_factor'], True)
+    _drain(loader)
+    restart, _ = _drain(loader)
+    del loader
+    restart = _all_ranks(restart, dist.ReduceOp.MAX)
+    config = {'num_workers': best['num_workers'], 'prefetch_factor': best['prefetch_factor'],
+              'persistent_workers': restart < best['startup_s']}
+    probes.append({'persistent_restart_s': restart})
+    return config, probes
+
+
+def autotune(dataset, collate_fn, batch_size, step_rate, cache_path, batches=20, headroom=1.1,
+             log=None, **extra):
+    """The cached configuration for this setup, probing (and caching) it if there is none.
+
+    A collective when distributed. Rank 0's cache decides for everyone, so all ranks
+    agree on whether to probe even if their hosts' caches differ.
+    """
+    info = fingerprint(dataset, batch_size, **extra)
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    config = [load_cached(cache_path, info) if rank == 0 else None]
+    if distributed:
+        dist.broadcast_object_list(config, src=0)
+    config = config[0]
+    if config is not None:
+        if log is not None:
+            log('=> loader config from {}: {}'.format(cache_path, config))
+        return config
+
+    target = _all_ranks(step_rate, dist.ReduceOp.MAX)
+    if log is not None:
+        log('=> probing loader configurations against a step rate of {:.1f} images/sec per rank'.format(target))
+    config, probes = probe(dataset, collate_fn, batch_size, target, batches=batches,
+                           headroom=headroom, log=log)
+    if rank == 0:
+        store(cache_path, info, config, probes)
+        if log is not None:
+            log('=> loader config {} cached in {}'.format(config, cache_path))
+    return config
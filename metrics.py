@@ -0,0 +1,58 @@
+"""Loss and accuracy accumulated on the device.
+
+update() adds the loss sum, top-k correct counts and the sample count of a batch to
+a small device tensor without synchronizing with the host. reduce() sums that
+tensor over all ranks in one allreduce and reads it back in one sync, so logging
+costs one collective per log interval instead of three per batch, and the epoch
+totals are exact global counts rather than averages of per-rank percentages.
+"""
+import collections
+
+import torch
+import torch.distributed as dist
+
+Metric = collections.namedtuple('Metric', ['val', 'avg'])
+
+
+class MetricAccumulator(object):
+    def __init__(self, device, topk=(1, 5)):
+        self.topk = topk
+        # [loss sum, correct@k for every k, sample count]; float64 keeps counts exact
+        self.totals = torch.zeros(len(topk) + 2, dtype=torch.float64, device=device)
+        self.last = [0.] * len(self.totals)
+
+    def update(self, output, target, loss):
+        """Add a batch; loss is the mean loss over its samples"""
+        n = target.size(0)
+        if n == 0:
+            return
+        with torch.no_grad():
+            maxk = min(max(self.topk), output.size(1))
+            _, pred = output.topk(maxk, 1, True, True)
+            correct = pred.eq(target.view(-1, 1))
+            self.totals[0] += loss.detach().double() * n
+            for j, k in enumerate(self.topk):
+                self.totals[j + 1] += correct[:, :k].sum()
+            self.totals[-1] += n
+
+    def reduce(self):
+        """Global metrics since the previous reduce() (val) and since the start (avg).
+
+        A collective: every rank has to call it at the same point.
+        """
+        totals = self.totals.clone()
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)
+        totals = totals.tolist()
+        window = [t - l for t, l in zip(totals, self.last)]
+        self.last = totals
+
+        def summarize(values):
+            count = max(values[-1], 1.)
+            result = {'loss': values[0] / count, 'count': values[-1]}
+            for j, k in enumerate(self.topk):
+                result['top{}'.format(k)] = 100. * values[j + 1] / count
+            return result
+
+        val, avg = summarize(window), summarize(totals)
+        return {name: Metric(val[name], avg[name]) for name in avg}
@@ -0,0 +1,77 @@
+"""SGD setup and the learning rate schedule.
+
+make_sgd() builds torch.optim.SGD with multi-tensor updates: foreach (one kernel
+per op over all parameters instead of one per parameter) or fused (one kernel
+for the whole update, where torch supports it). Weight decay only applies to
+conv and linear weights. BN weights and biases are left out, as is common for
+ImageNet training; --bn-weight-decay brings the old behaviour back.
+
+LRSchedule precomputes the learning rate of every step of the run: a linear
+warmup over the first warmup_epochs, then a decay by 10x at epochs 30, 60, 80
+and every 30 epochs after that. Reaching into the table is all apply() does per
+step, and it only touches the param groups when the rate changed.
+"""
+import torch
+
+
+def param_groups(model, weight_decay, bn_weight_decay=False):
+    """Parameter groups with and without weight decay"""
+    if bn_weight_decay:
+        return [{'params': list(model.parameters()), 'weight_decay': weight_decay}]
+    decay, no_decay = [], []
+    for p in model.parameters():
+        if not p.requires_grad:
+            continue
+        # BN weights and biases are 1-d, conv and linear weights aren't
+        (no_decay if p.ndim <= 1 else decay).append(p)
+    return [{'params': decay, 'weight_decay': weight_decay},
+            {'params': no_decay, 'weight_decay': 0.}]
+
+
+def make_sgd(model, lr, momentum, weight_decay, impl='foreach', bn_weight_decay=False):
+    """SGD with the update implementation impl: fused, foreach or for-loop"""
+    kwargs = {'foreach': impl == 'foreach'}
+    if impl == 'fused':
+        kwargs = {'fused': True}
+    return torch.optim.SGD(param_groups(model, weight_decay, bn_weight_decay), lr,
+                           momentum=momentum, **kwargs)
+
+
+def decay_factor(epoch):
+    """How many times the learning rate has been divided by 10 in epoch"""
+    factor = epoch // 30
+    if epoch >= 80:
+        factor = factor + 1
+    return factor
+
+
+class LRSchedule(object):
+    """LR schedule that should yield 76% converged accuracy with batch size 256"""
+    def __init__(self, base_lr, epochs, len_epoch, warmup_epochs=5):
+        self.len_epoch = len_epoch
+        # row epoch, column step: steps count from 1, column 0 is the epoch's start
+        steps = torch.arange(len_epoch + 1, dtype=torch.float64)
+        rows = []
+        for epoch in range(epochs):
+            lr = base_lr * (0.1 ** decay_factor(epoch))
+            if epoch < warmup_epochs:
+                rows.append(lr * (1 + steps + epoch * len_epoch) / (warmup_epochs * len_epoch))
+            else:
+                rows.append(torch.full_like(steps, lr))
+        self.table = torch.stack(rows) if rows else torch.zeros(0, len_epoch + 1, dtype=torch.float64)
+        self.current = None
+
+    def lr(self, epoch, step):
+        return self.table[epoch, step].item()
+
+    def apply(self, optimizer, epoch, step):
+        lr = self.lr(epoch, step)
+        if lr != self.current:
+            for param_group in optimizer.param_groups:
+                if torch.is_tensor(param_group['lr']):
+                    # a compiled optimizer step reads it from the tensor, see compiled_step.py
+                    param_group['lr'].fill_(lr)
+                else:
+                    param_group['lr'] = lr
+            self.current = lr
+        return lr
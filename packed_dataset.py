@@ -0,0 +1,171 @@
+"""Packed, memory-mapped ImageNet shards.
+
+Walking and opening 1.28M small JPEGs every epoch is what kills the data path on
+metadata-heavy filesystems. pack an ImageFolder tree once:
+
+python packed_dataset.py --src /ssd2/imagenet --dst /ssd2/imagenet_packed
+
+and train with --data /ssd2/imagenet_packed --data-format packed.
+
+Every split becomes <dst>/<split>/shard_NNNNN.bin (the raw encoded files, back to
+back) plus <dst>/<split>/index.npz holding offsets, lengths, labels and shard ids
+as flat numpy arrays, so opening a split is one small np.load instead of a
+directory walk.
+"""
+import argparse
+import io
+import os
+
+import numpy as np
+import torch.utils.data
+import torchvision.datasets.folder as folder
+from PIL import Image
+
+INDEX_FILE = 'index.npz'
+SHARD_FILE = 'shard_{:05d}.bin'
+
+
+class _RecordFile(io.RawIOBase):
+    """Read-only file object over a memoryview, so PIL decodes straight out of the mmap"""
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self.buf) - self.pos)
+        if n <= 0:
+            return 0
+        b[:n] = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = len(self.buf) + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """Drop-in replacement for datasets.ImageFolder reading a split written by pack_split()"""
+    def __init__(self, root, transform=None, target_transform=None):
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+
+        with np.load(os.path.join(root, INDEX_FILE)) as index:
+            self.offsets = index['offsets']
+            self.lengths = index['lengths']
+            self.labels = index['labels']
+            self.shard_ids = index['shard_ids']
+            self.classes = [str(c) for c in index['classes']]
+            self.shard_files = [os.path.join(root, str(s)) for s in index['shards']]
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.targets = self.labels
+        # encoded file sizes, e.g. to estimate decode cost
+        self.sizes = self.lengths
+        # shards are mapped lazily, so every loader worker gets its own mappings.
+        self._maps = {}
+
+    def __getstate__(self):
+        # never pickle the mappings (np.memmap would serialize as a full copy).
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _shard(self, shard_id):
+        mm = self._maps.get(shard_id)
+        if mm is None:
+            mm = np.memmap(self.shard_files[shard_id], dtype=np.uint8, mode='r')
+            self._maps[shard_id] = mm
+        return mm
+
+    def record(self, index):
+        """Raw encoded bytes of sample index, as a zero-copy view into its shard"""
+        offset = int(self.offsets[index])
+        return self._shard(int(self.shard_ids[index]))[offset:offset + int(self.lengths[index])]
+
+    def __getitem__(self, index):
+        img = Image.open(_RecordFile(self.record(index)))
+        img = img.convert('RGB')
+        target = int(self.labels[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+
+def pack_split(src, dst, shard_size=1 << 30):
+    """Pack the ImageFolder tree src into shards of about shard_size bytes under dst"""
+    classes, class_to_idx = folder.find_classes(src)
+    samples = folder.make_dataset(src, class_to_idx, extensions=folder.IMG_EXTENSIONS)
+    os.makedirs(dst, exist_ok=True)
+
+    n = len(samples)
+    offsets = np.zeros(n, dtype=np.int64)
+    lengths = np.zeros(n, dtype=np.int64)
+    labels = np.zeros(n, dtype=np.int64)
+    shard_ids = np.zeros(n, dtype=np.int32)
+    shards = []
+
+    out = None
+    pos = 0
+    for i, (path, label) in enumerate(samples):
+        if out is None or pos >= shard_size:
+            if out is not None:
+                out.close()
+            shards.append(SHARD_FILE.format(len(shards)))
+            out = open(os.path.join(dst, shards[-1]), 'wb')
+            pos = 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        out.write(data)
+        offsets[i] = pos
+        lengths[i] = len(data)
+        labels[i] = label
+        shard_ids[i] = len(shards) - 1
+        pos += len(data)
+    if out is not None:
+        out.close()
+
+    # write the index last, so a split without index.npz is known to be incomplete.
+    np.savez(os.path.join(dst, INDEX_FILE), offsets=offsets, lengths=lengths, labels=labels,
+             shard_ids=shard_ids, classes=np.array(classes), shards=np.array(shards))
+    return n, len(shards)
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Pack ImageNet folders into memory-mapped shards')
+    parser.add_argument('--src', type=str, required=True, metavar='DIR', help='ImageFolder root containing the splits')
+    parser.add_argument('--dst', type=str, required=True, metavar='DIR', help='output root for the packed splits')
+    parser.add_argument('--splits', nargs='+', default=['train', 'val'], help='splits to pack (default: train val)')
+    parser.add_argument('--shard-size', default=1024, type=int, metavar='MB', help='approximate shard size in MB (default: 1024)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    for split in args.splits:
+        n, n_shards = pack_split(os.path.join(args.src, split), os.path.join(args.dst, split),
+                                 shard_size=args.shard_size << 20)
+        print('=> packed {} samples of {} into {} shards'.format(n, split, n_shards))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Native mixed precision, in place of apex amp.
+
+--precision picks the autocast dtype of forward passes:
+    fp32    no autocast (the default)
+    bf16    torch.autocast to bfloat16, on cuda and cpu; bf16 has fp32's exponent
+            range, so no loss scaling is needed
+    fp16    torch.autocast to float16 with a dynamic GradScaler, cuda only
+
+The weights and optimizer state stay fp32 either way, so checkpoints, gradient
+sync and the optimizer are the same for every precision. Backward runs outside of
+autocast, which replays the casts of the forward pass.
+"""
+import contextlib
+
+import torch
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+DTYPES = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class MixedPrecision(object):
+    def __init__(self, precision, device):
+        if precision == 'fp16' and not device.is_cuda:
+            raise ValueError('--precision fp16 needs cuda, use bf16 on cpu')
+        self.precision = precision
+        self.dtype = DTYPES[precision]
+        self.device_type = device.device.type
+        self.scaler = torch.cuda.amp.GradScaler() if precision == 'fp16' else None
+
+    def autocast(self):
+        """Context manager for forward passes"""
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizer):
+        """optimizer.step(), skipped by the scaler if the gradients overflowed"""
+        if self.scaler is None:
+            optimizer.step()
+            return
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict() if self.scaler is not None else {}
+
+    def load_state_dict(self, state):
+        if self.scaler is not None and state:
+            self.scaler.load_state_dict(state)
@@ -0,0 +1,159 @@
+"""Multi-batch prefetching from a DataLoader to the device.
+
+PrefetchQueue keeps up to depth batches ready on the device, so a slow loader
+worker only stalls training once the whole queue has drained. A background thread
+pulls batches from the loader, stages them in a recycled pool of pinned host
+buffers, copies them to the device and normalizes them on a side stream, i.e.
+overlapped with the forward/backward of the batches before. Without an accelerator
+the same thread just normalizes on the CPU, which keeps the buffering logic
+identical everywhere. An optional batched augmentation (batch_augment.py) runs
+on the device batch just ahead of normalization.
+
+Loading starts as soon as the queue is constructed, so a queue created ahead of
+time, e.g. for the next epoch while validation and checkpointing run, has its
+first batches ready when training asks for them. stats() reports how long after
+construction the first batch was ready and how long the first next() waited for
+it, i.e. the idle time at the start of the epoch.
+"""
+import queue
+import threading
+import time
+
+import torch
+
+_END = object()
+
+
+class PrefetchQueue(object):
+    def __init__(self, loader, device, depth=2, augment=None):
+        self.loader = iter(loader)
+        self.device = device
+        self.depth = max(depth, 1)
+        # batched augmentation of the float batch ahead of normalization, e.g. BatchAugment
+        self.augment = augment
+        self.stream = device.new_stream()
+        self.mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).to(device.device).view(1,3,1,1)
+        self.std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).to(device.device).view(1,3,1,1)
+
+        # depth batches queued plus one being filled; a buffer is free again once the
+        # event of its host->device copy completed.
+        self._pool = []
+        self._pool_size = self.depth + 1
+        self._next_buffer = 0
+
+        self.batches = 0
+        self.starved = 0
+        self.wait_time = 0.
+        self.occupancy = 0
+        self.created = time.perf_counter()
+        self.first_ready = None
+        self.first_wait = None
+
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name='prefetch', daemon=True)
+        self._thread.start()
+
+    def _stage(self, input):
+        """Copy input into the next pinned buffer of the pool"""
+        if len(self._pool) < self._pool_size:
+            self._pool.append([torch.empty_like(input, pin_memory=True), None])
+        slot = self._pool[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % self._pool_size
+        buf, event = slot
+        if buf.shape != input.shape:
+            # e.g. the last batch of an epoch; not worth a pool slot
+            return input.pin_memory(), slot
+        if event is not None:
+            event.synchronize()
+        buf.copy_(input)
+        return buf, slot
+
+    def _load(self, input, target):
+        slot = None
+        if self.device.is_cuda:
+            input, slot = self._stage(input)
+        with self.device.stream(self.stream):
+            input = input.to(self.device.device, non_blocking=True)
+            target = target.to(self.device.device, non_blocking=True)
+            input = input.float()
+            if self.augment is not None:
+                input = self.augment(input)
+            input = input.sub_(self.mean).div_(self.std)
+        event = self.device.record_event(self.stream)
+        if slot is not None:
+            slot[1] = event
+        return input, target, event
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self):
+        self.device.set_current()
+        try:
+            for input, target in self.loader:
+                item = self._load(input, target)
+                if self.first_ready is None:
+                    self.first_ready = time.perf_counter() - self.created
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(_END)
+
+    def next(self):
+        """The next (input, target) on the device, (None, None) once the loader is exhausted"""
+        if self._queue.empty():
+            start = time.perf_counter()
+            item = self._queue.get()
+            wait = time.perf_counter() - start
+            queued = 0
+        else:
+            wait = None
+            queued = self._queue.qsize()
+            item = self._queue.get()
+        if item is _END:
+            # keep answering None, like the loader keeps raising StopIteration
+            self._queue.put(_END)
+            return None, None
+        if isinstance(item, Exception):
+            raise item
+
+        input, target, event = item
+        # only real batches count: waiting for the end marker isn't starvation, and it
+        # would push the mean occupancy above depth
+        self.batches += 1
+        self.occupancy += queued
+        if wait is not None:
+            self.starved += 1
+            self.wait_time += wait
+        if self.first_wait is None:
+            self.first_wait = wait or 0.
+        current = self.device.wait_event(event)
+        if current is not None:
+            input.record_stream(current)
+            target.record_stream(current)
+        return input, target
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def stats(self):
+        requests = max(self.batches, 1)
+        return {
+            'batches': self.batches,
+            'starved': self.starved,
+            'wait_s': self.wait_time,
+            'mean_occupancy': self.occupancy / requests,
+            'depth': self.depth,
+            'startup_s': self.first_ready or 0.,
+            'first_wait_s': self.first_wait or 0.,
+        }
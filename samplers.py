@@ -0,0 +1,118 @@
+import itertools
+
+import torch
+import torch.utils.data
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """Wraps a sampler with set_epoch() (e.g. DistributedSampler) so an epoch can start mid-way.
+
+    set_epoch(epoch, start) makes the next pass skip the first start indices of that
+    epoch's order. Only the indices are skipped, the samples behind them are never
+    loaded, so fast-forwarding is free.
+    """
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+        self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.start, None)
+
+    def __len__(self):
+        return max(len(self.sampler) - self.start, 0)
+
+
+class BalancedDistributedSampler(torch.utils.data.Sampler):
+    """DistributedSampler alternative with local reads and cost-balanced steps.
+
+    Every epoch the dataset is cut into blocks of block_size consecutive indices (in
+    an ImageFolder or packed split, neighbouring files on disk), the blocks are
+    shuffled, and the samples are shuffled only within windows of window blocks, so
+    reads stay within a few regions of the data at a time. The smaller the window,
+    the fewer classes a batch of a class-sorted split mixes; the defaults shuffle
+    over 64k samples.
+
+    Every global step of num_replicas * batch_size samples is then dealt to the ranks
+    in snake order by decreasing cost (e.g. the encoded file size, a proxy for
+    decode time), so every rank gets the same number of samples and about the same
+    total decode work, and no rank's loader has to wait for one full of large JPEGs.
+
+    Like DistributedSampler, the order is padded with its first samples to a
+    multiple of num_replicas, every sample is seen once per epoch and set_epoch()
+    reseeds. All ranks compute the same global order, so they need the same seed.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, batch_size=1, costs=None,
+                 block_size=64, window=1024, seed=0):
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.batch_size = batch_size
+        self.block_size = max(block_size, 1)
+        self.window = max(window, 1)
+        self.seed = seed
+        self.epoch = 0
+        self.size = len(dataset)
+        if costs is None:
+            costs = torch.ones(self.size)
+        self.costs = torch.as_tensor(costs, dtype=torch.float64)
+        self.num_samples = -(-self.size // num_replicas)
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def global_order(self):
+        """The padded order of the whole epoch, before it is dealt to the ranks"""
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        num_blocks = -(-self.size // self.block_size)
+        blocks = torch.randperm(num_blocks, generator=g)
+        windows = []
+        for start in range(0, num_blocks, self.window):
+            members = blocks[start:start + self.window]
+            # block b holds indices b*block_size ... b*block_size + block_size - 1
+            indices = (members.unsqueeze(1) * self.block_size + torch.arange(self.block_size)).view(-1)
+            indices = indices[indices < self.size]
+            windows.append(indices[torch.randperm(len(indices), generator=g)])
+        order = torch.cat(windows)
+        if self.total_size > self.size:
+            padding = order.repeat(-(-(self.total_size - self.size) // self.size))
+            order = torch.cat([order, padding[:self.total_size - self.size]])
+        return order
+
+    def _deal(self, steps):
+        """This rank's share of every row of steps, a (n, m) tensor of indices with m % num_replicas == 0"""
+        ranked = steps.gather(1, self.costs[steps].argsort(dim=1, descending=True))
+        pos = torch.arange(steps.size(1))
+        turn, seat = pos // self.num_replicas, pos % self.num_replicas
+        owner = torch.where(turn % 2 == 0, seat, self.num_replicas - 1 - seat)
+        return ranked[:, owner == self.rank].reshape(-1)
+
+    def __iter__(self):
+        order = self.global_order()
+        step = self.batch_size * self.num_replicas
+        full = len(order) // step * step
+        mine = [self._deal(order[:full].view(-1, step))]
+        if full < len(order):
+            mine.append(self._deal(order[full:].view(1, -1)))
+        return iter(torch.cat(mine).tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def num_unpadded(sampler, dataset_size):
+    """How many of the indices a DistributedSampler hands its rank are real samples.
+
+    To give every rank the same number of samples, DistributedSampler pads its index
+    list with repeats at the end, and rank r takes every num_replicas-th index from
+    position r. The repeats are therefore always the last indices of a rank's share.
+    """
+    if sampler is None:
+        return dataset_size
+    return len(range(sampler.rank, dataset_size, sampler.num_replicas))
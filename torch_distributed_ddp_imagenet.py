@@ -1,6 +1,8 @@
 import argparse
+import contextlib
+import functools
+import json
 import os
-import shutil
 import time
 import logging
 from datetime import datetime
@@ -17,65 +19,101 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
 
-import numpy as np
-import copy
+import activation_checkpoint
+from batch_augment import BatchAugment
+from checkpoint import AsyncCheckpointer, checkpoint_exists, load_checkpoint, model_state_dict, rng_state, set_rng_state
+from collate import FastCollate
+import compiled_step
+from dataset_index import IndexedImageFolder
+from device import DeviceContext, default_device
+import elastic
+import grad_sync
+from image_cache import CachedDataset
+from instrumentation import StageTimer, format_summaries
+import loader_autotune
+from metrics import MetricAccumulator
+from optimization import LRSchedule, make_sgd
+from packed_dataset import PackedDataset
+from precision import PRECISIONS, MixedPrecision
+from prefetch import PrefetchQueue
+from samplers import BalancedDistributedSampler, ResumableSampler, num_unpadded
 
 _logger = logging.getLogger('APEX_DDP')
 _logger.setLevel(logging.INFO)
 
 try:
-    from apex.parallel import DistributedDataParallel as DDP
-    from apex.fp16_utils import *
-    from apex import amp, optimizers
-    from apex.multi_tensor_apply import multi_tensor_applier
+    import apex
+    has_apex = True
 except ImportError:
-    raise ImportError("Please install apex from https://www.github.com/nvidia/apex to run this example.")
-
-def fast_collate(batch, memory_format):
-
-    imgs = [img[0] for img in batch]
-    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-    w = imgs[0].size[0]
-    h = imgs[0].size[1]
-    tensor = torch.zeros( (len(imgs), 3, h, w), dtype=torch.uint8).contiguous(memory_format=memory_format)
-    for i, img in enumerate(imgs):
-        nump_array = np.asarray(img, dtype=np.uint8)
-        if(nump_array.ndim < 3):
-            nump_array = np.expand_dims(nump_array, axis=-1)
-        nump_array = np.rollaxis(nump_array, 2)
-        nump_array_writable = copy.deepcopy(nump_array)
-        tensor[i] += torch.from_numpy(nump_array_writable)
-    return tensor, targets
-
+    # apex is optional, only --grad-sync apex/apex-overlap and apex's sync BN use it.
+    has_apex = False
 
 def parse():
     model_names = sorted(name for name in models.__dict__ if name.islower() and not name.startswith("__") and callable(models.__dict__[name]))
 
     parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
     parser.add_argument('--data', type=str, default='/ssd2/imagenet', metavar='DIR', help='path to dataset')
+    parser.add_argument('--cache-dir', type=str, default='', metavar='DIR', help='cache decoded val crops (and pre-resized train images with --cache-train-size) in DIR (default: none)')
+    parser.add_argument('--cache-ram', default=0, type=int, metavar='MB', help='in-RAM LRU budget per cache and rank in MB (default: 0)')
+    parser.add_argument('--cache-train-size', default=0, type=int, metavar='N', help='cache train images resized and center cropped to NxN, random crops are taken from those (default: 0, off)')
+    parser.add_argument('--batch-augment', action='store_true', help='random-resized-crop and flip whole batches on the device instead of per image in the loader workers')
+    parser.add_argument('--batch-augment-source', default=0, type=int, metavar='N', help='with --batch-augment, loaders resize and center crop images to NxN sources (default: --cache-train-size if set, else 256)')
+    parser.add_argument('--prefetch-depth', default=2, type=int, metavar='N', help='batches prefetched to the device ahead of the training step (default: 2)')
+    parser.add_argument('--data-format', type=str, default='folder', choices=['folder', 'packed'], help='folder: ImageFolder tree, packed: shards written by packed_dataset.py (default: folder)')
+    parser.add_argument('--index-cache', type=str, default=os.path.expanduser('~/.cache/imagenet_distributed_torch/index'), metavar='DIR', help="with --data-format folder, keep the file index of train/ and val/ in DIR, built once by rank 0 instead of scanning the tree on every rank; '' scans with datasets.ImageFolder")
+    parser.add_argument('--sampler', type=str, default='random', choices=['random', 'balanced'], help='random: DistributedSampler, balanced: block-local shuffling with steps balanced by file size over the ranks (default: random)')
+    parser.add_argument('--sampler-block', default=64, type=int, metavar='N', help='with --sampler balanced, consecutive samples read together (default: 64)')
+    parser.add_argument('--sampler-window', default=1024, type=int, metavar='N', help='with --sampler balanced, blocks shuffled together (default: 1024)')
     parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18', choices=model_names, help='model architecture: | '.join(model_names) + ' (default: resnet18)')
     parser.add_argument('-j', '--workers', default=32, type=int, metavar='N', help='number of data loading workers (default: 4)')
+    parser.add_argument('--prefetch-factor', default=2, type=int, metavar='N', help='batches loaded ahead by every loader worker (default: 2)')
+    parser.add_argument('--persistent-workers', dest='persistent_workers', action='store_true', default=True, help='keep the loader workers alive between epochs and across the train/val switch (default)')
+    parser.add_argument('--no-persistent-workers', dest='persistent_workers', action='store_false', help='fork fresh loader workers for every pass over a loader')
+    parser.add_argument('--autotune-loader', action='store_true', help='pick -j, --prefetch-factor and --persistent-workers by probing the train loader against the model step rate, cached per host and dataset')
+    parser.add_argument('--autotune-cache', type=str, default=os.path.expanduser('~/.cache/imagenet_distributed_torch/loader_autotune.json'), metavar='PATH', help='where --autotune-loader keeps its results')
     parser.add_argument('--epochs', default=90, type=int, metavar='N', help='number of total epochs to run')
     parser.add_argument('--start-epoch', default=0, type=int, metavar='N', help='manual epoch number (useful on restarts)')
     parser.add_argument('-b', '--batch-size', default=128, type=int, metavar='N', help='mini-batch size per process (default: 256)')
-    parser.add_argument('--lr', '--learning-rate', default=0.1, type=float, metavar='LR', help='Initial learning rate.  Will be scaled by <global batch size>/256: args.lr = args.lr*float(args.batch_size*args.world_size)/256.  A warmup schedule will also be applied over the first 5 epochs.')
+    parser.add_argument('--lr', '--learning-rate', default=0.1, type=float, metavar='LR', help='Initial learning rate.  Will be scaled by <effective global batch size>/256: args.lr = args.lr*float(args.batch_size*args.world_size*args.accum_steps)/256.  A warmup schedule will also be applied over the first 5 epochs.')
     parser.add_argument('--momentum', default=0.9, type=float, metavar='M', help='momentum')
     parser.add_argument('--weight-decay', '--wd', default=1e-4, type=float, metavar='W', help='weight decay (default: 1e-4)')
+    parser.add_argument('--optimizer-impl', type=str, default='foreach', choices=['foreach', 'fused', 'for-loop'], help='SGD update: foreach (multi-tensor), fused (single kernel, if torch supports it for the device) or for-loop (per parameter) (default: foreach)')
+    parser.add_argument('--bn-weight-decay', action='store_true', help='also apply weight decay to BN weights and biases')
     parser.add_argument('--print-freq', '-p', default=50, type=int, metavar='N', help='print frequency (default: 10)')
     parser.add_argument('--resume', default='', type=str, metavar='PATH', help='path to latest checkpoint (default: none)')
+    parser.add_argument('--checkpoint-dir', type=str, default='', metavar='DIR', help='where checkpoint.pth.tar and model_best.pth.tar are written (default: current directory)')
+    parser.add_argument('--elastic', action='store_true', help='run under an elastic torchrun rendezvous: every (re)start resumes from the latest checkpoint in --checkpoint-dir with the current world size, see elastic.py')
+    parser.add_argument('--global-batch-size', default=0, type=int, metavar='N', help='set -b to N / (world size x --accum-steps), so the global batch and LR stay the same when the world size changes (default: 0, use -b)')
+    parser.add_argument('--checkpoint-shards', action='store_true', help='every rank writes its share of the checkpoint instead of rank 0 writing all of it')
+    parser.add_argument('--checkpoint-steps', default=0, type=int, metavar='N', help='also checkpoint every N training steps, mid-epoch (default: 0, off)')
+    parser.add_argument('--checkpoint-minutes', default=0, type=float, metavar='M', help='also checkpoint mid-epoch once M minutes passed since the last checkpoint, checked every --print-freq steps (default: 0, off)')
+    parser.add_argument('--sync-checkpoint', action='store_true', help='wait for checkpoints to be written instead of writing them in the background')
     parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true', help='evaluate model on validation set')
     parser.add_argument('--pretrained', dest='pretrained', action='store_true', help='use pre-trained model')
 
     parser.add_argument('--prof', default=-1, type=int, help='Only run 10 iterations for profiling.')
+    parser.add_argument('--timeline', action='store_true', help='record per-stage step timings and log them every epoch')
+    parser.add_argument('--timeline-dir', type=str, default='', metavar='DIR', help='also export every epoch as a Chrome trace per rank plus a JSON summary to DIR')
+    parser.add_argument('--timeline-sync', action='store_true', help='synchronize the device after every stage, so stages time kernels instead of launches')
     parser.add_argument('--deterministic', action='store_true')
 
-    parser.add_argument("--local_rank", default=os.getenv('LOCAL_RANK', 0), type=int)
-    parser.add_argument('--sync_bn', action='store_true', help='enabling apex sync BN.')
-
-    parser.add_argument('--opt-level', type=str,default='O0')
-    parser.add_argument('--keep-batchnorm-fp32', type=str, default=None)
-    parser.add_argument('--loss-scale', type=str, default=None)
-    parser.add_argument('--channels-last', type=bool, default=False)
+    parser.add_argument("--local_rank", "--local-rank", default=os.getenv('LOCAL_RANK', 0), type=int)
+    parser.add_argument('--device', type=str, default=default_device(), choices=['cuda', 'cpu'], help='cuda: nccl, cpu: gloo (default: cuda if available)')
+    parser.add_argument('--sync_bn', action='store_true', help='synchronized BN, apex\'s if installed, else torch.nn.SyncBatchNorm (cuda only)')
+
+    parser.add_argument('--grad-sync', type=str, default=None, choices=grad_sync.MODES, help='gradient allreduce: apex (after backward), apex-overlap or ddp (bucketed, overlapped with backward) (default: apex on cuda if installed, else ddp)')
+    parser.add_argument('--bucket-cap-mb', default=25, type=int, metavar='MB', help='gradient bucket size for apex-overlap and ddp (default: 25)')
+    parser.add_argument('--grad-compression', type=str, default='none', choices=grad_sync.COMPRESSIONS, help='compress ddp gradient buckets for the allreduce (default: none)')
+    parser.add_argument('--powersgd-rank', default=2, type=int, metavar='R', help='rank of the PowerSGD approximation (default: 2)')
+    parser.add_argument('--accum-steps', default=1, type=int, metavar='N', help='accumulate gradients over N batches per optimizer step, allreducing only on the last; the effective batch is N x -b per process (default: 1)')
+    parser.add_argument('--act-checkpoint', default=0, type=int, metavar='N', help='recompute activations in backward, keeping only N >= 2 segment boundaries per sequential stage of the model (default: 0, off)')
+    parser.add_argument('--act-checkpoint-stages', nargs='+', default=None, metavar='NAME', help='with --act-checkpoint, only checkpoint these stages, e.g. layer1 layer2 (default: all)')
+
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS, help='autocast dtype: fp32 (off), bf16 (cuda and cpu) or fp16 with dynamic loss scaling (cuda) (default: fp32)')
+    parser.add_argument('--channels-last', action='store_true', help='NHWC model weights and input batches')
+    parser.add_argument('--compile', type=str, default='none', choices=compiled_step.MODES, help='torch.compile the model or the whole training step (forward, loss, backward, optimizer), see compiled_step.py (default: none)')
+    parser.add_argument('--compile-mode', type=str, default=None, choices=['default', 'reduce-overhead', 'max-autotune', 'max-autotune-no-cudagraphs'], help='torch.compile mode (default: reduce-overhead, i.e. CUDA graph replay, on a single GPU, else default)')
+    parser.add_argument('--compile-cache-dir', type=str, default=os.path.expanduser('~/.cache/imagenet_distributed_torch/inductor'), metavar='DIR', help='where compiled kernels and graphs are kept across runs')
     args = parser.parse_args()
     return args
 
@@ -111,7 +149,8 @@ def main():
         _logger.info('args=={}'.format(args))
         # _logger.info("keep_batchnorm_fp32 = {}, type=={}".format(args.keep_batchnorm_fp32), type(args.keep_batchnorm_fp32))
         # _logger.info("loss_scale = {}, type=={}".format(args.loss_scale), type(args.loss_scale))
-        _logger.info("\nCUDNN VERSION: {}\n".format(torch.backends.cudnn.version()))
+        if args.device == 'cuda':
+            _logger.info("\nCUDNN VERSION: {}\n".format(torch.backends.cudnn.version()))
 
     cudnn.benchmark = True
     best_prec1 = 0
@@ -127,15 +166,56 @@ def main():
 
     args.gpu = 0
     args.world_size = 1
+    args.rank = 0
 
     if args.distributed:
         args.gpu = args.local_rank
-        torch.cuda.set_device(args.gpu)
-        torch.distributed.init_process_group(backend='nccl',
+
+    global device
+    device = DeviceContext(args.device, args.gpu)
+    # apex DDP and sync BN only run on cuda, and only if apex is installed.
+    args.apex = device.is_cuda and has_apex
+    if not device.is_cuda:
+        if args.sync_bn:
+            raise RuntimeError("--sync_bn is not supported with --device cpu.")
+        if args.prof >= 0:
+            raise RuntimeError("--prof uses nvtx ranges, it is not supported with --device cpu.")
+
+    global precision
+    precision = MixedPrecision(args.precision, device)
+
+    if args.distributed:
+        device.set_current()
+        torch.distributed.init_process_group(backend=device.backend,
                                              init_method='env://')
         args.world_size = torch.distributed.get_world_size()
-
-    assert torch.backends.cudnn.enabled, "Amp requires cudnn backend to be enabled."
+        args.rank = torch.distributed.get_rank()
+
+    if args.elastic:
+        if not elastic.launched_by_torchrun():
+            raise RuntimeError("--elastic needs to be launched by torchrun with a rendezvous backend, see elastic.py.")
+        if args.checkpoint_shards:
+            raise RuntimeError("--checkpoint-shards is not supported with --elastic, see elastic.py.")
+        if not args.checkpoint_dir:
+            raise RuntimeError("--elastic needs a --checkpoint-dir shared by all nodes, see elastic.py.")
+        if args.local_rank == 0:
+            _logger.info("=> elastic start {} with {} processes".format(elastic.restart_count(), args.world_size))
+        # --resume only seeds the first start, restarts continue from the latest checkpoint
+        latest = checkpoint_path('checkpoint.pth.tar')
+        if not args.resume or (elastic.restart_count() > 0 and checkpoint_exists(latest)):
+            args.resume = latest
+    if args.global_batch_size > 0:
+        args.batch_size = max(args.global_batch_size // (args.world_size * args.accum_steps), 1)
+
+    global timer, checkpointer
+    checkpointer = AsyncCheckpointer(shard=args.checkpoint_shards,
+                                     rank=args.rank,
+                                     world_size=args.world_size, device=device,
+                                     blocking=args.sync_checkpoint)
+    # --prof only needs the nvtx ranges of the stages, --timeline the recorded timings.
+    timer = StageTimer(record=args.timeline or bool(args.timeline_dir), nvtx=args.prof >= 0,
+                       sync=args.timeline_sync, device=device,
+                       rank=args.rank)
 
     if args.channels_last:
         memory_format = torch.channels_last
@@ -151,57 +231,100 @@ def main():
         model = models.__dict__[args.arch]()
 
     if args.sync_bn:
-        import apex
-        _logger.info("using apex synced BN")
-        model = apex.parallel.convert_syncbn_model(model)
-
-    model = model.cuda().to(memory_format=memory_format)
-
-    # Scale learning rate based on global batch size
-    args.lr = args.lr*float(args.batch_size*args.world_size)/256.
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
-
-    # Initialize Amp.  Amp accepts either values or strings for the optional override arguments,
-    # for convenient interoperation with argparse.
-    model, optimizer = amp.initialize(model, optimizer,
-                                      opt_level=args.opt_level,
-                                      keep_batchnorm_fp32=args.keep_batchnorm_fp32,
-                                      loss_scale=args.loss_scale
-                                      )
-
-    # For distributed training, wrap the model with apex.parallel.DistributedDataParallel.
-    # This must be done AFTER the call to amp.initialize.  If model = DDP(model) is called
-    # before model, ... = amp.initialize(model, ...), the call to amp.initialize may alter
-    # the types of model's parameters in a way that disrupts or destroys DDP's allreduce hooks.
-    if args.distributed:
-        # By default, apex.parallel.DistributedDataParallel overlaps communication with
-        # computation in the backward pass.
-        # model = DDP(model)
-        # delay_allreduce delays all communication to the end of the backward pass.
-        model = DDP(model, delay_allreduce=True)
+        if args.apex:
+            _logger.info("using apex synced BN")
+            model = apex.parallel.convert_syncbn_model(model)
+        else:
+            _logger.info("using torch synced BN")
+            model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
-    # define loss function (criterion) and optimizer
-    criterion = nn.CrossEntropyLoss().cuda()
+    if args.act_checkpoint > 0:
+        stages = activation_checkpoint.apply(model, args.act_checkpoint, args.act_checkpoint_stages)
+        _logger.info("=> checkpointing activations of {} in {} segments each".format(', '.join(stages), args.act_checkpoint))
 
-    # Optionally resume from a checkpoint
+    model = model.to(device.device, memory_format=memory_format)
+
+    # Scale learning rate based on the global batch of one optimizer step
+    args.effective_batch_size = args.batch_size*args.world_size*args.accum_steps
+    args.lr = args.lr*float(args.effective_batch_size)/256.
+    if args.local_rank == 0:
+        _logger.info("=> effective global batch {} ({} x {} processes x {} accumulation steps), lr {}".format(
+            args.effective_batch_size, args.batch_size, args.world_size, args.accum_steps, args.lr))
+    optimizer = make_sgd(model, args.lr, args.momentum, args.weight_decay,
+                         impl=args.optimizer_impl, bn_weight_decay=args.bn_weight_decay)
+
+    # Optionally resume from a checkpoint, before the model is wrapped: DDP broadcasts
+    # rank 0's parameters and buffers when it wraps it, so all replicas start alike
+    args.start_step = 0
     if args.resume:
         # Use a local scope to avoid dangling references
         def resume():
-            if os.path.isfile(args.resume):
+            if checkpoint_exists(args.resume):
                 _logger.info("=> loading checkpoint '{}'".format(args.resume))
-                checkpoint = torch.load(args.resume, map_location = lambda storage, loc: storage.cuda(args.gpu))
+                # memory-mapped on the host: load_state_dict copies each tensor into the
+                # device parameters and optimizer state, no full copy on the device first
+                checkpoint = load_checkpoint(args.resume, map_location='cpu')
                 args.start_epoch = checkpoint['epoch']
+                # mid-epoch checkpoints continue their epoch after args.start_step steps, counted
+                # in steps of the current batch size and world size
+                args.start_step = elastic.resume_step(checkpoint, args.batch_size, args.world_size, args.accum_steps)
+                if checkpoint.get('world_size', args.world_size) != args.world_size:
+                    _logger.info("=> world size changed from {} to {}".format(checkpoint['world_size'], args.world_size))
                 global best_prec1
                 best_prec1 = checkpoint['best_prec1']
-                model.load_state_dict(checkpoint['state_dict'])
+                # the checkpoint may come from another world size, with or without DDP
+                model.load_state_dict(model_state_dict(checkpoint['state_dict']))
                 optimizer.load_state_dict(checkpoint['optimizer'])
-                _logger.info("=> loaded checkpoint '{}' (epoch {})"
-                      .format(args.resume, checkpoint['epoch']))
+                precision.load_state_dict(checkpoint.get('scaler'))
+                # checkpoints of --compile step keep the lr as a tensor
+                for param_group in optimizer.param_groups:
+                    if torch.is_tensor(param_group['lr']):
+                        param_group['lr'] = param_group['lr'].item()
+                if 'rng_states' in checkpoint:
+                    rng_states = checkpoint['rng_states']
+                    set_rng_state(rng_states[args.rank % len(rng_states)])
+                _logger.info("=> loaded checkpoint '{}' (epoch {} step {})"
+                      .format(args.resume, checkpoint['epoch'], args.start_step))
             else:
                 _logger.info("=> no checkpoint found at '{}'".format(args.resume))
         resume()
+    if args.elastic and args.distributed:
+        # every rank has to continue where rank 0 does, or the replicas silently diverge
+        resumed = torch.tensor([args.start_epoch, args.start_step], dtype=torch.int64, device=device.device)
+        expected = resumed.clone()
+        dist.broadcast(expected, 0)
+        mismatch = torch.tensor([float(not torch.equal(resumed, expected))], device=device.device)
+        dist.all_reduce(mismatch, op=dist.ReduceOp.MAX)
+        if mismatch.item():
+            raise RuntimeError("ranks resumed from different checkpoints (this rank: epoch {} step {}, rank 0: "
+                               "epoch {} step {}), is --checkpoint-dir shared by all nodes?".format(
+                               args.start_epoch, args.start_step, *expected.tolist()))
+
+    # For distributed training, wrap the model for gradient sync. Autocast leaves the
+    # parameters fp32, so every --precision allreduces the same fp32 gradients.
+    if args.distributed:
+        # apex delays all communication to the end of the backward pass, apex-overlap and
+        # ddp overlap it with the backward pass, see grad_sync.py.
+        if args.grad_sync is None:
+            args.grad_sync = 'apex' if args.apex and args.compile == 'none' else 'ddp'
+        elif args.grad_sync.startswith('apex') and not args.apex:
+            raise RuntimeError("--grad-sync {} needs apex on cuda, use ddp.".format(args.grad_sync))
+        elif args.grad_sync.startswith('apex') and args.compile != 'none':
+            raise RuntimeError("--compile needs --grad-sync ddp.")
+        model = grad_sync.wrap(model, args.grad_sync, device, bucket_cap_mb=args.bucket_cap_mb,
+                               compression=args.grad_compression, powersgd_rank=args.powersgd_rank)
+
+    # define loss function (criterion) and optimizer
+    criterion = nn.CrossEntropyLoss().to(device.device)
+
+    global forward_step
+    if args.compile != 'none':
+        compiled_step.enable_cache(args.compile_cache_dir)
+        args.compile_mode = args.compile_mode or compiled_step.default_mode(device, args.distributed)
+        _logger.info("=> compiling the {} (mode {}), the first steps include the compile time".format(
+            args.compile, args.compile_mode))
+    forward_step = compiled_step.setup(model, criterion, optimizer, precision, device,
+                                       compile=args.compile, mode=args.compile_mode)
 
     # Data loading code
     traindir = os.path.join(args.data, 'train')
@@ -215,185 +338,243 @@ def main():
         crop_size = 224
         val_size = 256
 
-    train_dataset = datasets.ImageFolder(
-        traindir,
-        transforms.Compose([
+    if args.data_format == 'packed':
+        dataset_cls = PackedDataset
+    elif args.index_cache:
+        dataset_cls = functools.partial(IndexedImageFolder, cache_dir=args.index_cache,
+                                        log=_logger.info if args.rank == 0 else None)
+    else:
+        dataset_cls = datasets.ImageFolder
+
+    train_transform = transforms.Compose([
             transforms.RandomResizedCrop(crop_size),
             transforms.RandomHorizontalFlip(),
             # transforms.ToTensor(), Too slow
             # normalize,
-        ]))
-    val_dataset = datasets.ImageFolder(valdir, transforms.Compose([
+        ])
+    val_transform = transforms.Compose([
             transforms.Resize(val_size),
             transforms.CenterCrop(crop_size),
+        ])
+
+    global batch_augment
+    batch_augment = None
+    if args.batch_augment:
+        # loaders only decode fixed-size sources; crop, flip and normalization run batched
+        # on the device, in the prefetch thread.
+        source_size = args.batch_augment_source or args.cache_train_size or val_size
+        batch_augment = BatchAugment(crop_size, rank=args.rank)
+        train_transform = None
+
+    if args.cache_dir and args.cache_train_size > 0:
+        # the deterministic resize is cached, the random crop runs on the cached image
+        train_dataset = CachedDataset(
+            dataset_cls(traindir, transforms.Compose([
+                transforms.Resize(args.cache_train_size),
+                transforms.CenterCrop(args.cache_train_size),
+            ])),
+            args.cache_dir, args.cache_train_size, transform=train_transform,
+            ram_bytes=args.cache_ram << 20, num_workers=args.workers)
+    elif args.batch_augment:
+        train_dataset = dataset_cls(traindir, transforms.Compose([
+            transforms.Resize(source_size),
+            transforms.CenterCrop(source_size),
         ]))
-
-    train_sampler = None
+    else:
+        train_dataset = dataset_cls(traindir, train_transform)
+
+    val_dataset = dataset_cls(valdir, val_transform)
+    if args.cache_dir:
+        val_dataset = CachedDataset(val_dataset, args.cache_dir, crop_size,
+                                    ram_bytes=args.cache_ram << 20, num_workers=args.workers)
+
+    # a seeded, resumable order also without distribution, so a mid-epoch checkpoint can
+    # fast-forward through the indices its epoch already consumed.
+    if args.sampler == 'balanced':
+        # file sizes as decode cost; the images of a CachedDataset all cost the same
+        train_sampler = BalancedDistributedSampler(
+            train_dataset, num_replicas=args.world_size, rank=args.rank, batch_size=args.batch_size,
+            costs=getattr(train_dataset, 'sizes', None), block_size=args.sampler_block, window=args.sampler_window)
+    else:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(
+            train_dataset, num_replicas=args.world_size, rank=args.rank)
+    train_sampler = ResumableSampler(train_sampler)
     val_sampler = None
     if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
         val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset)
 
-    collate_fn = lambda b: fast_collate(b, memory_format)
+    collate_fn = FastCollate(memory_format)
 
+    if args.autotune_loader and not args.evaluate:
+        autotune_loader(train_dataset, val_dataset, collate_fn, model, criterion, crop_size, memory_format)
+
+    loader_kwargs = {}
+    if args.workers > 0:
+        loader_kwargs = dict(prefetch_factor=args.prefetch_factor, persistent_workers=args.persistent_workers)
+
+    # the worker seeds come from a generator of their own, not from the global RNG: the
+    # next epoch's loader starts before the epoch's checkpoint records the RNG states.
+    global loader_generator
+    loader_generator = torch.Generator()
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=False, sampler=train_sampler, collate_fn=collate_fn)
+        train_dataset, batch_size=args.batch_size, shuffle=False,
+        num_workers=args.workers, pin_memory=False, sampler=train_sampler, collate_fn=collate_fn,
+        generator=loader_generator, drop_last=args.compile != 'none', **loader_kwargs)
 
     val_loader = torch.utils.data.DataLoader(
         val_dataset,
         batch_size=args.batch_size, shuffle=False,
         num_workers=args.workers, pin_memory=False,
         sampler=val_sampler,
-        collate_fn=collate_fn)
+        collate_fn=collate_fn, **loader_kwargs)
 
     if args.evaluate:
         validate(val_loader, model, criterion)
         return
 
+    global last_checkpoint_time
+    last_checkpoint_time = time.time()
+    len_epoch = len(train_loader)
+    global lr_schedule
+    lr_schedule = LRSchedule(args.lr, args.epochs, len_epoch)
+    prefetcher = start_epoch(train_loader, args.start_epoch, args.start_step)
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
-            train_sampler.set_epoch(epoch)
+        start_step = args.start_step if epoch == args.start_epoch else 0
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch)
+        train(prefetcher, model, criterion, optimizer, epoch, start_step, len_epoch)
+        # before the next epoch starts loading, whose batches would count in this epoch's stats
+        if args.local_rank == 0:
+            log_prefetch_stats('train', prefetcher)
+            log_cache_stats('train', train_loader.dataset)
+        # with persistent workers the next epoch's first batches load while validation and
+        # the checkpoint run, instead of after them
+        prefetcher = None
+        if epoch + 1 < args.epochs:
+            prefetcher = start_epoch(train_loader, epoch + 1, 0)
+        if timer.record:
+            log_timeline(epoch)
 
         # evaluate on validation set
         prec1 = validate(val_loader, model, criterion)
 
         # remember best prec@1 and save checkpoint
-        if args.local_rank == 0:
-            is_best = prec1 > best_prec1
-            best_prec1 = max(prec1, best_prec1)
-            save_checkpoint({
-                'epoch': epoch + 1,
-                'arch': args.arch,
-                'state_dict': model.state_dict(),
-                'best_prec1': best_prec1,
-                'optimizer' : optimizer.state_dict(),
-            }, is_best)
-
-class data_prefetcher():
-    def __init__(self, loader):
-        self.loader = iter(loader)
-        self.stream = torch.cuda.Stream()
-        self.mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).cuda().view(1,3,1,1)
-        self.std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).cuda().view(1,3,1,1)
-        # With Amp, it isn't necessary to manually convert data to half.
-        # if args.fp16:
-        #     self.mean = self.mean.half()
-        #     self.std = self.std.half()
-        self.preload()
-
-    def preload(self):
-        try:
-            self.next_input, self.next_target = next(self.loader)
-        except StopIteration:
-            self.next_input = None
-            self.next_target = None
-            return
-        # if record_stream() doesn't work, another option is to make sure device inputs are created
-        # on the main stream.
-        # self.next_input_gpu = torch.empty_like(self.next_input, device='cuda')
-        # self.next_target_gpu = torch.empty_like(self.next_target, device='cuda')
-        # Need to make sure the memory allocated for next_* is not still in use by the main stream
-        # at the time we start copying to next_*:
-        # self.stream.wait_stream(torch.cuda.current_stream())
-        with torch.cuda.stream(self.stream):
-            self.next_input = self.next_input.cuda(non_blocking=True)
-            self.next_target = self.next_target.cuda(non_blocking=True)
-            # more code for the alternative if record_stream() doesn't work:
-            # copy_ will record the use of the pinned source tensor in this side stream.
-            # self.next_input_gpu.copy_(self.next_input, non_blocking=True)
-            # self.next_target_gpu.copy_(self.next_target, non_blocking=True)
-            # self.next_input = self.next_input_gpu
-            # self.next_target = self.next_target_gpu
-
-            # With Amp, it isn't necessary to manually convert data to half.
-            # if args.fp16:
-            #     self.next_input = self.next_input.half()
-            # else:
-            self.next_input = self.next_input.float()
-            self.next_input = self.next_input.sub_(self.mean).div_(self.std)
-
-    def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        input = self.next_input
-        target = self.next_target
-        if input is not None:
-            input.record_stream(torch.cuda.current_stream())
-        if target is not None:
-            target.record_stream(torch.cuda.current_stream())
-        self.preload()
-        return input, target
-
-
-def train(train_loader, model, criterion, optimizer, epoch):
+        is_best = prec1 > best_prec1
+        best_prec1 = max(prec1, best_prec1)
+        save_checkpoint(model, optimizer, epoch + 1, 0, is_best)
+
+    # the last checkpoint may still be in flight
+    checkpointer.wait()
+
+def start_epoch(train_loader, epoch, start_step):
+    """Seed the train order and augmentation of epoch and start prefetching its batches"""
+    train_loader.sampler.set_epoch(epoch, start=start_step * args.batch_size)
+    if batch_augment is not None:
+        batch_augment.set_epoch(epoch, skip_batches=start_step, batch_size=args.batch_size)
+    # only used for the worker seeds of non-persistent workers and -j 0
+    loader_generator.manual_seed((epoch * 1000 + start_step) * 100003 + args.rank)
+    return PrefetchQueue(train_loader, device, args.prefetch_depth, augment=batch_augment)
+
+def autotune_loader(train_dataset, val_dataset, collate_fn, model, criterion, crop_size, memory_format):
+    """Set args.workers, args.prefetch_factor and args.persistent_workers from loader_autotune"""
+    # forward and backward on a synthetic batch, as fast as the model will ever want data
+    input = torch.randn(args.batch_size, 3, crop_size, crop_size, device=device.device)
+    input = input.contiguous(memory_format=memory_format)
+    target = torch.randint(0, 1000, (args.batch_size,), device=device.device)
+    buffers = [b.detach().clone() for b in model.buffers()]
+
+    def step():
+        with precision.autocast():
+            loss = criterion(model(input), target)
+        precision.backward(loss)
+
+    model.train()
+    step_rate = loader_autotune.measure_step_rate(step, args.batch_size, device=device)
+    # leave no trace of the probe steps in the BN statistics or the gradients
+    with torch.no_grad():
+        for b, saved in zip(model.buffers(), buffers):
+            b.copy_(saved)
+    model.zero_grad(set_to_none=True)
+
+    log = _logger.info if args.local_rank == 0 else None
+    config = loader_autotune.autotune(train_dataset, collate_fn, args.batch_size, step_rate, args.autotune_cache,
+                                      log=log, arch=args.arch, device=device.name(),
+                                      channels_last=args.channels_last, batch_augment=args.batch_augment,
+                                      precision=args.precision)
+    args.workers = config['num_workers']
+    args.prefetch_factor = config['prefetch_factor']
+    args.persistent_workers = config['persistent_workers']
+    for dataset in (train_dataset, val_dataset):
+        if isinstance(dataset, CachedDataset):
+            dataset.set_num_workers(args.workers)
+    if args.local_rank == 0:
+        _logger.info('=> loader: {} workers, prefetch factor {}, persistent workers {}'.format(
+            args.workers, args.prefetch_factor, args.persistent_workers))
+
+
+def train(prefetcher, model, criterion, optimizer, epoch, start_step, len_epoch):
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    metrics = MetricAccumulator(device.device)
 
     # switch to train mode
     model.train()
     end = time.time()
 
-    prefetcher = data_prefetcher(train_loader)
-    input, target = prefetcher.next()
-    i = 0
+    with timer.stage('data'):
+        input, target = prefetcher.next()
+    # i counts from the start of the epoch, also when resuming mid-epoch
+    i = start_step
     while input is not None:
         i += 1
+        timer.step = i
         if args.prof >= 0 and i == args.prof:
             _logger.info("Profiling begun at iteration {}".format(i))
             torch.cuda.cudart().cudaProfilerStart()
 
-        if args.prof >= 0: torch.cuda.nvtx.range_push("Body of iteration {}".format(i))
-
-        adjust_learning_rate(optimizer, epoch, i, len(train_loader))
-
-        # compute output
-        if args.prof >= 0: torch.cuda.nvtx.range_push("forward")
-        output = model(input)
-        if args.prof >= 0: torch.cuda.nvtx.range_pop()
-        loss = criterion(output, target)
-
-        # compute gradient and do SGD step
-        optimizer.zero_grad()
-
-        if args.prof >= 0: torch.cuda.nvtx.range_push("backward")
-        with amp.scale_loss(loss, optimizer) as scaled_loss:
-            scaled_loss.backward()
-        if args.prof >= 0: torch.cuda.nvtx.range_pop()
+        # with --accum-steps, gradients of several batches add up before one SGD step, and
+        # only the last batch's backward allreduces them. DDP decides in its forward
+        # whether backward syncs, so the forward runs under sync too.
+        first = (i - 1) % args.accum_steps == 0
+        last = i % args.accum_steps == 0 or i == len_epoch
+        sync = contextlib.nullcontext() if last else grad_sync.no_sync(model)
+
+        if first:
+            optimizer.zero_grad()
+
+        with sync:
+            # compute output
+            with timer.stage('forward'):
+                output, loss = forward_step(input, target)
+
+            # compute gradient; the gradient allreduce is part of backward.
+            with timer.stage('backward'):
+                if args.accum_steps > 1:
+                    loss_step = loss / args.accum_steps
+                else:
+                    loss_step = loss
+                precision.backward(loss_step)
 
         # for param in model.parameters():
         #     print(param.data.double().sum().item(), param.grad.data.double().sum().item())
 
-        if args.prof >= 0: torch.cuda.nvtx.range_push("optimizer.step()")
-        optimizer.step()
-        if args.prof >= 0: torch.cuda.nvtx.range_pop()
+        if last:
+            # the rate only matters at the step, so all micro-batches of a step share it
+            lr_schedule.apply(optimizer, epoch, i)
+            with timer.stage('optimizer'):
+                precision.step(optimizer)
+
+        # accumulated on the device, no host sync
+        metrics.update(output, target, loss)
 
         if i%args.print_freq == 0:
             # Every print_freq iterations, check the loss, accuracy, and speed.
             # For best performance, it doesn't make sense to print these metrics every
             # iteration, since they incur an allreduce and some host<->device syncs.
 
-            # Measure accuracy
-            prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-
-            # Average loss and accuracy across processes for logging
-            if args.distributed:
-                reduced_loss = reduce_tensor(loss.data)
-                prec1 = reduce_tensor(prec1)
-                prec5 = reduce_tensor(prec5)
-            else:
-                reduced_loss = loss.data
-
-            # to_python_float incurs a host<->device sync
-            losses.update(to_python_float(reduced_loss), input.size(0))
-            top1.update(to_python_float(prec1), input.size(0))
-            top5.update(to_python_float(prec5), input.size(0))
+            # one allreduce and one host<->device sync for all metrics of the interval
+            with timer.stage('allreduce'):
+                m = metrics.reduce()
 
-            torch.cuda.synchronize()
             batch_time.update((time.time() - end)/args.print_freq)
             end = time.time()
 
@@ -404,18 +585,18 @@ def train(train_loader, model, criterion, optimizer, epoch):
                       'Loss {loss.val:.10f} ({loss.avg:.4f})\t'
                       'Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t'
                       'Prec@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
-                       epoch, i, len(train_loader),
+                       epoch, i, len_epoch,
                        args.world_size*args.batch_size/batch_time.val,
                        args.world_size*args.batch_size/batch_time.avg,
                        batch_time=batch_time,
-                       loss=losses, top1=top1, top5=top5))
-        if args.prof >= 0: torch.cuda.nvtx.range_push("prefetcher.next()")
-        input, target = prefetcher.next()
-        if args.prof >= 0: torch.cuda.nvtx.range_pop()
-        # if i>= 51: break
+                       loss=m['loss'], top1=m['top1'], top5=m['top5']))
+        # only between optimizer steps, a checkpoint can't hold half-accumulated gradients
+        if last and checkpoint_due(i):
+            save_checkpoint(model, optimizer, epoch, i, False)
 
-        # Pop range "Body of iteration {}".format(i)
-        if args.prof >= 0: torch.cuda.nvtx.range_pop()
+        with timer.stage('data'):
+            input, target = prefetcher.next()
+        # if i>= 51: break
 
         if args.prof >= 0 and i == args.prof + 10:
             _logger.info("Profiling ended at iteration {}".format(i))
@@ -425,45 +606,43 @@ def train(train_loader, model, criterion, optimizer, epoch):
 
 def validate(val_loader, model, criterion):
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    metrics = MetricAccumulator(device.device)
 
     # switch to evaluate mode
     model.eval()
 
     end = time.time()
 
-    prefetcher = data_prefetcher(val_loader)
+    # samples past this many on this rank are DistributedSampler padding, repeats of
+    # samples other ranks evaluate; they are left out so the accuracy is exact.
+    num_samples = num_unpadded(val_loader.sampler if args.distributed else None, len(val_loader.dataset))
+    seen = 0
+
+    prefetcher = PrefetchQueue(val_loader, device, args.prefetch_depth)
     input, target = prefetcher.next()
     i = 0
     while input is not None:
         i += 1
 
-        # compute output
-        with torch.no_grad():
-            output = model(input)
-            loss = criterion(output, target)
-
-        # measure accuracy and record loss
-        prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
+        valid = min(max(num_samples - seen, 0), input.size(0))
+        seen += input.size(0)
+        if valid < input.size(0):
+            input, target = input[:valid], target[:valid]
 
-        if args.distributed:
-            reduced_loss = reduce_tensor(loss.data)
-            prec1 = reduce_tensor(prec1)
-            prec5 = reduce_tensor(prec5)
-        else:
-            reduced_loss = loss.data
+        # compute output
+        if valid > 0:
+            with torch.no_grad(), precision.autocast():
+                output = model(input)
+                loss = criterion(output, target)
+            metrics.update(output, target, loss)
 
-        losses.update(to_python_float(reduced_loss), input.size(0))
-        top1.update(to_python_float(prec1), input.size(0))
-        top5.update(to_python_float(prec5), input.size(0))
+        # TODO:  Change timings to mirror train().
+        if i % args.print_freq == 0:
+            m = metrics.reduce()
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+            batch_time.update((time.time() - end)/args.print_freq)
+            end = time.time()
 
-        # TODO:  Change timings to mirror train().
         if args.local_rank == 0 and i % args.print_freq == 0:
             _logger.info('Test: [{0}/{1}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
@@ -474,21 +653,98 @@ def validate(val_loader, model, criterion):
                    i, len(val_loader),
                    args.world_size * args.batch_size / batch_time.val,
                    args.world_size * args.batch_size / batch_time.avg,
-                   batch_time=batch_time, loss=losses,
-                   top1=top1, top5=top5))
+                   batch_time=batch_time, loss=m['loss'],
+                   top1=m['top1'], top5=m['top5']))
 
         input, target = prefetcher.next()
 
-    _logger.info(' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'
-          .format(top1=top1, top5=top5))
+    m = metrics.reduce()
+    _logger.info(' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f} ({0:.0f} images)'
+          .format(m['count'].avg, top1=m['top1'], top5=m['top5']))
 
-    return top1.avg
+    if args.local_rank == 0:
+        log_prefetch_stats('val', prefetcher)
+        log_cache_stats('val', val_loader.dataset)
+
+    return m['top1'].avg
+
+
+def checkpoint_due(step):
+    if args.checkpoint_steps > 0 and step % args.checkpoint_steps == 0:
+        return True
+    if args.checkpoint_minutes > 0 and step % args.print_freq == 0:
+        # rank 0's clock decides, every rank has to take part in the checkpoint
+        due = torch.tensor([time.time() - last_checkpoint_time >= args.checkpoint_minutes * 60.],
+                           dtype=torch.float32, device=device.device)
+        if args.distributed:
+            dist.broadcast(due, 0)
+        return bool(due.item())
+    return False
 
 
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, 'model_best.pth.tar')
+def save_checkpoint(model, optimizer, epoch, step, is_best):
+    """Checkpoint after step steps of epoch (step 0: at the start of epoch)"""
+    global last_checkpoint_time
+    rng_states = [rng_state()]
+    if args.distributed:
+        rng_states = [None] * args.world_size
+        dist.all_gather_object(rng_states, rng_state())
+    # a single writer: with several nodes, every local rank 0 would write the same file
+    if args.checkpoint_shards or args.rank == 0:
+        checkpointer.save({
+            'epoch': epoch,
+            'step': step,
+            # where step is in the epoch for any batch and world size
+            'samples': step * args.batch_size * args.world_size,
+            'world_size': args.world_size,
+            'arch': args.arch,
+            'state_dict': getattr(model, 'module', model).state_dict(),
+            'best_prec1': best_prec1,
+            'optimizer' : optimizer.state_dict(),
+            'scaler': precision.state_dict(),
+            'rng_states': rng_states,
+        }, is_best, filename=checkpoint_path('checkpoint.pth.tar'),
+           best_filename=checkpoint_path('model_best.pth.tar'))
+    last_checkpoint_time = time.time()
+
+
+def checkpoint_path(name):
+    if not args.checkpoint_dir:
+        return name
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    return os.path.join(args.checkpoint_dir, name)
+
+
+def log_timeline(epoch):
+    summaries = timer.gather_summaries()
+    if args.local_rank == 0:
+        _logger.info(' * Epoch {} step stages:'.format(epoch))
+        for line in format_summaries(summaries):
+            _logger.info(line)
+    if args.timeline_dir:
+        os.makedirs(args.timeline_dir, exist_ok=True)
+        timer.export_chrome_trace(os.path.join(args.timeline_dir,
+            'timeline_epoch{}_rank{}.trace.json'.format(epoch, timer.rank)))
+        if timer.rank == 0:
+            with open(os.path.join(args.timeline_dir, 'timeline_epoch{}.json'.format(epoch)), 'w') as f:
+                json.dump(summaries, f, indent=2)
+    timer.reset()
+
+
+def log_prefetch_stats(name, prefetcher):
+    _logger.info(' * {} prefetch: {batches} batches, starved {starved} times for {wait_s:.3f} s, '
+                 'mean queue occupancy {mean_occupancy:.2f}/{depth}'.format(name, **prefetcher.stats()))
+    # the idle time at the start of the pass: how long the first step waited for data
+    _logger.info(' * {} turnover: first batch ready {startup_s:.3f} s after loading started, '
+                 'first step waited {first_wait_s:.3f} s for it'.format(name, **prefetcher.stats()))
+
+
+def log_cache_stats(name, dataset):
+    if isinstance(dataset, CachedDataset):
+        _logger.info(' * {} cache: hits {hits_ram} ram / {hits_disk} disk, misses {misses}, evictions {evictions}'
+                     .format(name, **dataset.stats()))
+        # the counters live in shared memory, so this also resets them in the (persistent) workers
+        dataset.reset_stats()
 
 
 class AverageMeter(object):
@@ -509,47 +765,5 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-def adjust_learning_rate(optimizer, epoch, step, len_epoch):
-    """LR schedule that should yield 76% converged accuracy with batch size 256"""
-    factor = epoch // 30
-
-    if epoch >= 80:
-        factor = factor + 1
-
-    lr = args.lr*(0.1**factor)
-
-    """Warmup"""
-    if epoch < 5:
-        lr = lr*float(1 + step + epoch*len_epoch)/(5.*len_epoch)
-
-    # if(args.local_rank == 0):
-    #     print("epoch = {}, step = {}, lr = {}".format(epoch, step, lr))
-
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-
-def accuracy(output, target, topk=(1,)):
-    """Computes the precision@k for the specified values of k"""
-    maxk = max(topk)
-    batch_size = target.size(0)
-
-    _, pred = output.topk(maxk, 1, True, True)
-    pred = pred.t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-    res = []
-    for k in topk:
-        correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
-        res.append(correct_k.mul_(100.0 / batch_size))
-    return res
-
-
-def reduce_tensor(tensor):
-    rt = tensor.clone()
-    dist.all_reduce(rt, op=dist.reduce_op.SUM)
-    rt /= args.world_size
-    return rt
-
 if __name__ == '__main__':
     main()